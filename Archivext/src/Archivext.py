@@ -2,6 +2,9 @@
 # !python3
 
 import logging
+import multiprocessing
+import queue
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
 
@@ -23,6 +26,11 @@ class Archivext(tk.Tk):
         arch_pattern = "archives_{0}{0}{0}{0}.txt".format("[0-9]")
         self.archives = archives.Archives(arch_directory, arch_pattern)
         self.signalements = []
+        self._loader_thread = None
+        self._loader_queue = queue.Queue()  # Chunks of signalements parsed by the loader thread
+        self._check_loader_id = None
+        self._reload = False
+        self._loaded_chunks = 0
 
         # Rendering
         try:
@@ -90,7 +98,7 @@ class Archivext(tk.Tk):
         headers = ['Date', 'Auteur', 'Code', 'Flag', 'Description', 'Statut', 'Respomap(s)']
         column_widths = [55, 85, 100, 80, 400, 350, 100]
         sort_keys = [
-            lambda x: (int(x[0].split("/")[2]), int(x[0].split("/")[1]), int(x[0].split("/")[0])),
+            lambda x: tuple(int(n) for n in reversed(x[0].split("/")[:3])),  # dd/mm/yy, all in 20yy
             lambda x: x[0].lower(),
             lambda x: x[0].lower(),
             lambda x: x[0].lower(),
@@ -111,7 +119,8 @@ class Archivext(tk.Tk):
         self.tree_sig = siglist.Siglist(self.main_frame, signalements=self.signalements, statusbar=self.statusbar,
                                         headers=headers, sort_keys=sort_keys, stretch_bools=stretch_bools, height=25,
                                         index_options=index_options, sortable=True, column_widths=column_widths,
-                                        match_template="{} sur {}", search_excludes=exclude, search_tags=search_tags)
+                                        match_template="{} sur {}", search_excludes=exclude, search_tags=search_tags,
+                                        virtual=True)
         self.searchbar.entry.configure(textvariable=self.tree_sig._search_query)
         self.label_matches.configure(textvariable=self.tree_sig._matches_label)
 
@@ -128,12 +137,59 @@ class Archivext(tk.Tk):
         self.searchbar.focus_out(None)
 
     def import_archives(self):
-        self.archives.fetch()
-        self.signalements = self.archives.signalements
-        if self.signalements:
-            self.refresh(scroll="down")
+        # Archives are read in a background thread, each archive file being displayed as soon as it's parsed
+        if self._loader_thread and self._loader_thread.is_alive():
+            self._reload = True
+            return
+        self._reload = False
+        self._loaded_chunks = 0
+        self.statusbar.set("Chargement des archives...", clear_after=0)
+        self._loader_thread = threading.Thread(target=self._load_archives, daemon=True)
+        self._loader_thread.start()
+        self._check_loader_id = self.after(100, self._check_loader)
+
+    def _load_archives(self):
+        logging.debug("Starting loader thread")
+        try:
+            self.archives.fetch(callback=lambda *chunk: self._loader_queue.put(chunk))
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self._loader_queue.put(None)
+        logging.debug("Stopping loader thread")
+
+    def _check_loader(self):
+        # Displays one chunk at a time so that the window stays responsive while a large backlog is drained
+        try:
+            chunk = self._loader_queue.get_nowait()
+        except queue.Empty:
+            self._check_loader_id = self.after(100, self._check_loader)
+            return
+        if chunk is None:
+            self._check_loader_id = None
+            self._archives_loaded()
+            return
+        signalements, done, total = chunk
+        if self._loaded_chunks == 0:
+            # Replaces the previous archives only once the new ones start coming in
+            self.signalements = []
+            self.refresh()
+        self._loaded_chunks += 1
+        self.tree_sig.extend(signalements)
+        self.statusbar.set(f"Chargement des archives... {done}/{total}", clear_after=0)
+        self.statusbar.set_amount(f"{len(self.signalements)} signalements")
+        self._check_loader_id = self.after(1, self._check_loader)
+
+    def _archives_loaded(self):
+        self.statusbar.clear()
+        if self._loaded_chunks:
+            self.tree_sig.build_index()
+            self.tree_sig.search(debounced=True)
+            self.tree_sig.scroll_down()
             self.statusbar.set_amount(f"{len(self.signalements)} signalements")
             self.statusbar.set_location(self.archives.dir_path)
+        if self._reload:
+            self.import_archives()
 
     def search(self):
         self.searchbar.focus()
@@ -145,7 +201,9 @@ class Archivext(tk.Tk):
         self.tree_sig.refresh()
         if archives:
             self.archives.fetch()
-        self.tree_sig.search()
+        if self._check_loader_id is None:
+            # While archives load, the chunks are filtered as they come in and _archives_loaded() searches again
+            self.tree_sig.search()
         if scroll == "down":
             self.tree_sig.scroll_down()
         elif scroll == "up":
@@ -156,12 +214,16 @@ class Archivext(tk.Tk):
         self.main_frame.focus_force()
 
     def exit(self):
+        if self._check_loader_id:
+            self.after_cancel(self._check_loader_id)
         self.destroy()
         logging.info("Exiting {}\n".format(__appname__))
         logging.shutdown()
 
 
 if __name__ == '__main__':
+    # Archives are parsed in worker processes, which the frozen executable has to be able to start
+    multiprocessing.freeze_support()
     log_level = utils.init_logging()
     logging.info("Starting {} {} [log_level={}]".format(__appname__, __version__, log_level))
 
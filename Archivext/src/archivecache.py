@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# !python3
+
+import logging
+import os
+import struct
+import sys
+from array import array
+
+from signalement import Signalement
+
+logger = logging.getLogger(__name__)
+
+# Binary cache of the parsed archive files, stored column by column:
+#
+#   header   MAGIC, byte order, number of files
+#   file     name, MD5 digest of its content, number of rows, string table, one array of string ids per column
+#
+# Every distinct cell value of a file is stored once in its string table, cells being 32-bit indexes into it.
+
+MAGIC = b"AXC1"
+COLUMNS = 7  # date, auteur, code, flag, desc, statut, respo
+_HEADER = struct.Struct("<4sBI")
+_FILE = struct.Struct("<H16sII")
+
+
+def load(path):
+    # Returns {filename: (digest, signalements)}, or an empty dict if there is no usable cache
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return {}
+    try:
+        return _decode(memoryview(data))
+    except (struct.error, ValueError, IndexError) as e:
+        logger.warning("Ignoring invalid cache \"{}\": {}".format(path, e))
+        return {}
+
+
+def _decode(data):
+    magic, little_endian, count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("bad magic number")
+    swap = bool(little_endian) != (sys.byteorder == "little")
+    offset = _HEADER.size
+    entries = {}
+    for _ in range(count):
+        name_size, digest, rows, strings_size = _FILE.unpack_from(data, offset)
+        offset += _FILE.size
+        name = bytes(data[offset:offset + name_size]).decode("utf-8")
+        offset += name_size
+        strings = bytes(data[offset:offset + strings_size]).decode("utf-8").split("\0")
+        offset += strings_size
+        ids = array("I")
+        ids.frombytes(data[offset:offset + rows * COLUMNS * ids.itemsize])
+        offset += rows * COLUMNS * ids.itemsize
+        if len(ids) != rows * COLUMNS:
+            raise ValueError("truncated file")
+        if swap:
+            ids.byteswap()
+        columns = [[strings[i] for i in ids[c * rows:(c + 1) * rows]] for c in range(COLUMNS)]
+        signalements = []
+        for date, auteur, code, flag, desc, statut, respo in zip(*columns):
+            respo = respo.split(", ") if respo else []
+            signalements.append(Signalement(date, auteur, code, flag, desc, statut, respo))
+        entries[name] = (digest.hex(), signalements)
+    return entries
+
+
+def save(path, entries):
+    # `entries` is {filename: (digest, signalements)}
+    chunks = [_HEADER.pack(MAGIC, sys.byteorder == "little", len(entries))]
+    for name, (digest, signalements) in entries.items():
+        strings = {}
+        columns = [array("I") for _ in range(COLUMNS)]
+        for sig in signalements:
+            values = (sig.date, sig.auteur, sig.code, sig.flag, sig.desc, sig.statut, ", ".join(sig.respo))
+            for column, value in zip(columns, values):
+                column.append(strings.setdefault(value, len(strings)))
+        name = name.encode("utf-8")
+        table = "\0".join(strings).encode("utf-8")
+        chunks.append(_FILE.pack(len(name), bytes.fromhex(digest), len(signalements), len(table)))
+        chunks.append(name)
+        chunks.append(table)
+        chunks.extend(column.tobytes() for column in columns)
+
+    tmp_path = "{}.tmp".format(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(chunks))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(e)
@@ -1,61 +1,224 @@
 # -*- coding: utf-8 -*-
 # !python3
 
+import hashlib
+import json
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import archivecache
 import utils
 from signalement import Signalement
 
 logger = logging.getLogger(__name__)
 
+# Below this amount of text to parse, starting worker processes costs more than it saves
+PARALLEL_MIN_SIZE = 256 * 1024
+
+
+class ArchiveFile():
+    # Keeps track of what has already been parsed from an archive file so that it is only read again when it changed,
+    # and only from the last parsed byte when lines were appended to it
+    TAIL_SIZE = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.size = -1
+        self.mtime = None
+        self.tail = b""  # Last parsed bytes, compared against the file before parsing only what was appended
+        self.md5 = hashlib.md5()
+        self.signalements = []
+
+    def changed(self, stat):
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime
+
+    def can_append(self, stat):
+        return stat.st_size > self.size > 0 and self.tail.endswith(b"\n")
+
+    def update(self, stat, data, signalements, append=False, md5=None):
+        if append:
+            self.md5.update(data)
+        else:
+            self.md5 = md5 if md5 else hashlib.md5(data)
+        self.size = (self.size if append else 0) + len(data)
+        self.mtime = stat.st_mtime_ns
+        self.tail = (self.tail + data if append else data)[-ArchiveFile.TAIL_SIZE:]
+        self.signalements = self.signalements + signalements if append else signalements
+
 
 class Archives():
 
-    def __init__(self, dir_path, pattern):
+    def __init__(self, dir_path, pattern, cache_path=None, manifest_path=None):
         self.dir_path = dir_path
         self.pattern = pattern
+        self.cache_path = cache_path if cache_path else dir_path.parent / "{}.cache".format(dir_path.name)
+        self.manifest_path = manifest_path if manifest_path else dir_path.parent / "{}.manifest".format(dir_path.name)
+        self._manifest = None
         self.signalements = []
+        self._archive_files = {}
+        self._cache = None
+        self._cache_dirty = False
 
     @property
     def files(self):
         return list(self.dir_path.glob(self.pattern))
 
-    def fetch(self):
-        self.signalements = []
-        for file in self.files:
-            logger.info("Reading \"{}\"".format(file))
+    def fetch(self, callback=None):
+        # `callback(signalements, done, total)` is called with the signalements of each archive file, in year order,
+        # as soon as they are available
+        if self._cache is None:
+            self._cache = archivecache.load(self.cache_path)
+        # Files are read concurrently, then the ones that have to be parsed from scratch are parsed in worker
+        # processes. Results are kept in year order whatever order the workers finish in.
+        files = sorted(self.files)
+        archive_files = [self._archive_files.get(file, ArchiveFile(file)) for file in files]
+        with ThreadPoolExecutor() as executor:
+            loaded = list(executor.map(self._load, archive_files))
+        pending = [(text, archive_file.path) for archive_file, text in zip(archive_files, loaded) if text]
+        results = self._parse_all(pending)
+        failed = set()
+        try:
+            for i, (archive_file, text) in enumerate(zip(archive_files, loaded)):
+                if text:
+                    archive_file.signalements = next(results)
+                    self._cache_dirty = True
+                if text is False or archive_file.signalements is None:
+                    failed.add(archive_file)
+                elif callback:
+                    callback(archive_file.signalements, i + 1, len(archive_files))
+        finally:
+            results.close()
+        self._archive_files = {archive_file.path: archive_file for archive_file in archive_files
+                               if archive_file not in failed}
+        self.signalements = [sig for archive_file in self._archive_files.values() for sig in archive_file.signalements]
+        if self._cache_dirty or self._cache.keys() != {file.name for file in self._archive_files}:
+            self.save_cache()
+
+    def save_cache(self):
+        self._cache = {file.name: (archive_file.md5.hexdigest(), archive_file.signalements)
+                       for file, archive_file in self._archive_files.items()}
+        logger.info("Writing cache \"{}\"".format(self.cache_path))
+        archivecache.save(self.cache_path, self._cache)
+        self._cache_dirty = False
+
+    def _load(self, archive_file):
+        # Returns the text left to parse, None if the archive file is up to date or False if it couldn't be read
+        try:
+            return self.read(archive_file)
+        except (IOError, ValueError, IndexError) as e:
+            logger.error(e)
+            return False
+
+    def _parse_all(self, texts):
+        # Yields the signalements parsed from each of `texts` in order, None for the ones that failed
+        done = 0
+        workers = min(len(texts), os.cpu_count() or 1)
+        if workers > 1 and sum(len(text) for text, _ in texts) >= PARALLEL_MIN_SIZE:
             try:
-                f = open(file, 'r', encoding='utf-8')
-            except IOError as e:
-                logger.error(e)
-            else:
-                try:
-                    raw_text = "".join(f.readlines()[2:])
-                    self.signalements.extend(self.parse(raw_text, file))
-                except (IOError, IndexError) as e:
-                    logger.error(e)
-                finally:
-                    f.close()
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for signalements in executor.map(_parse_safe, *zip(*texts)):
+                        yield signalements
+                        done += 1
+            except (OSError, RuntimeError) as e:
+                logger.warning("Parsing archives sequentially: {}".format(e))
+        for text, file in texts[done:]:
+            yield _parse_safe(text, file)
+
+    def read(self, archive_file):
+        stat = os.stat(archive_file.path)
+        if not archive_file.changed(stat):
+            return
+        with open(archive_file.path, 'rb') as f:
+            if archive_file.can_append(stat):
+                tail = archive_file.tail
+                f.seek(archive_file.size - len(tail))
+                data = f.read()
+                if data.startswith(tail):
+                    data = data[len(tail):]
+                    logger.info("Reading {} new bytes from \"{}\"".format(len(data), archive_file.path))
+                    archive_file.update(stat, data, self.parse(data.decode('utf-8'), archive_file.path), append=True)
+                    self._cache_dirty = True
+                    return
+                f.seek(0)
+            data = f.read()
+        md5 = hashlib.md5(data)
+        digest, signalements = self._cache.get(archive_file.path.name, (None, None))
+        if digest != md5.hexdigest():
+            logger.info("Reading \"{}\"".format(archive_file.path))
+            lines = data.decode('utf-8').split('\n', 2)
+            raw_text = lines[2] if len(lines) > 2 else ""
+            # Parsed by the caller, possibly alongside other files
+            archive_file.update(stat, data, [], md5=md5)
+            return raw_text
+        archive_file.update(stat, data, signalements, md5=md5)
 
     def parse(self, text, file, *, line_sep='\n', col_sep='|'):
-        signalements = []
-        year = utils.extract_numbers(str(file))[0]
-        if not isinstance(text, str):
-            return signalements
-        for line in text.split(line_sep):
-            if line.strip() != '':
-                values = [elem.strip() for elem in line.split(col_sep)]
-                values[0] = values[0] + "/" + year[2:]
-                values[4] = [respo.strip() for respo in values[4].split(",")] if values[4] else []
-                respo = values.pop(4)
-                values.append(respo)
-                s = Signalement(*values)
-                signalements.append(s)
-        return signalements
+        return parse(text, file, line_sep=line_sep, col_sep=col_sep)
+
+    def file_hashes(self):
+        # {filename: MD5} of the archive files, only hashing again the files whose size or mtime changed since the
+        # manifest was written
+        if self._manifest is None:
+            self._manifest = self._load_manifest()
+        entries = self._manifest["files"]
+        hashes = {}
+        changed = False
+        for file in sorted(self.files):
+            try:
+                stat = os.stat(file)
+            except OSError as e:
+                logger.error(e)
+                continue
+            entry = entries.get(file.name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                archive_file = self._archive_files.get(file)
+                if archive_file and not archive_file.changed(stat):
+                    md5 = archive_file.md5.hexdigest()
+                else:
+                    md5 = utils.hash_files([file])
+                entry = entries[file.name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": md5}
+                changed = True
+            hashes[file.name] = entry["md5"]
+        if entries.keys() != hashes.keys():
+            self._manifest["files"] = {name: entries[name] for name in hashes}
+            changed = True
+        if changed:
+            self._save_manifest()
+        return hashes
 
     def get_hash(self):
-        hash = utils.hash_files(self.files)
-        return hash
+        # Combines the hashes of the files like the root of a Merkle tree: comparing it to the remote one tells if
+        # anything changed, comparing the hashes of the files tells which ones did
+        return merkle_root(self.file_hashes())
+
+    def get_legacy_hash(self):
+        # MD5 of the content of all the files, as published by older servers. Only computed again when a file changed.
+        root = self.get_hash()
+        legacy = self._manifest.get("legacy")
+        if not legacy or legacy["root"] != root:
+            legacy = self._manifest["legacy"] = {"root": root, "hash": utils.hash_files(sorted(self.files))}
+            self._save_manifest()
+        return legacy["hash"]
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if isinstance(manifest.get("files"), dict):
+                return manifest
+        except (OSError, ValueError, AttributeError) as e:
+            logger.debug(e)
+        return {"files": {}}
+
+    def _save_manifest(self):
+        tmp_path = "{}.tmp".format(self.manifest_path)
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._manifest, f, indent=4)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            logger.error(e)
 
     def __len__(self):
         return len(self.signalements)
@@ -68,3 +231,36 @@ class Archives():
 
     def __str__(self):
         return "Sigs: {}".format(len(self.signalements))
+
+
+def parse(text, file, *, line_sep='\n', col_sep='|'):
+    signalements = []
+    year = utils.extract_numbers(str(file))[0]
+    if not isinstance(text, str):
+        return signalements
+    for line in text.split(line_sep):
+        if line.strip() != '':
+            values = [elem.strip() for elem in line.split(col_sep)]
+            values[0] = values[0] + "/" + year[2:]
+            values[4] = [respo.strip() for respo in values[4].split(",")] if values[4] else []
+            respo = values.pop(4)
+            values.append(respo)
+            s = Signalement(*values)
+            signalements.append(s)
+    return signalements
+
+
+def merkle_root(hashes):
+    # `hashes` is {filename: MD5}, combined in filename order
+    root = hashlib.md5()
+    for name in sorted(hashes):
+        root.update("{} {}\n".format(name, hashes[name]).encode("utf-8"))
+    return root.hexdigest()
+
+
+def _parse_safe(text, file):
+    # Runs in worker processes, an archive that fails to parse is left out like one that can't be read
+    try:
+        return parse(text, file)
+    except (ValueError, IndexError) as e:
+        logger.error("\"{}\": {}".format(file, e))
@@ -39,12 +39,12 @@ class Siglist(Treelist):
         self.tree.bind('<Control-x>', lambda _: self.copy())
         self.tree.bind('<Control-l>', lambda _: self.open_urls())
         self.tree.bind('<FocusOut>', self.remove_popups)
-        self.tree.bind('<<TreeviewSelect>>', self.selection_handler)
+        self.tree.bind('<<TreeviewSelect>>', self.selection_handler, add="+")
 
     def get_selected_sigs(self):
         selected = []
-        for item in self.tree.selection():
-            index = int(self.tree.item(item)['values'][0]) - 1
+        for values in self.selected_rows():
+            index = int(values[0]) - 1
             selected.append(self.signalements[index])
         return selected
 
@@ -119,7 +119,7 @@ class Siglist(Treelist):
     def selection_handler(self, event):
         self._last_selected_item = self.tree.focus()
         self.remove_popups()
-        sel = self.tree.selection()
+        sel = self.selected_rows()
         if sel:
             plural = "" if len(sel) == 1 else "s"
             self.statusbar.set("{0} signalement{1} sélectionné{1}".format(len(sel), plural), clear_after=0)
@@ -130,11 +130,18 @@ class Siglist(Treelist):
         for dialog in self._dialogs:
             dialog.cancel()
 
-    def populate(self):
-        for i, sig in enumerate(self.signalements):
+    def populate(self, signalements=None):
+        rows = []
+        for sig in self.signalements if signalements is None else signalements:
             f = list(sig.fields())
             f[-1] = ", ".join(f[-1])
-            self.insert(f)
+            rows.append(f)
+        self.insert_many(rows)
+
+    def extend(self, signalements):
+        # Appends rows without refreshing the ones already displayed, the search index being rebuilt on next use
+        self.signalements.extend(signalements)
+        self.populate(signalements)
 
     def refresh(self):
         self.close_dialogs()
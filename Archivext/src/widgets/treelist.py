@@ -1,19 +1,45 @@
 # -*- coding: utf-8 -*-
 # !python3
 
+import collections
 import logging
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
 
+import searchindex
 import searchparser
 
 logger = logging.getLogger(__name__)
 
 
+class _TreeScroll(ttk.Treeview):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_add("<<TreelistScroll>>", "None")
+        self.virtual_yview = None  # When set, scrolling is forwarded to it instead of moving the Treeview items
+
+    def yview(self, *args):
+        if args and self.virtual_yview:
+            result = self.virtual_yview(*args)
+        else:
+            result = super().yview(*args)
+        self.event_generate("<<TreelistScroll>>")
+        return result
+
+    def yview_moveto(self, fraction):
+        self.yview("moveto", fraction)
+
+    def yview_scroll(self, number, what):
+        self.yview("scroll", number, what)
+
+
 class Treelist(ttk.Frame):
+    SORT_CACHE_SIZE = 8
+
     def __init__(self, master, headers, column_widths=None, height=15, alt_colors=None, sortable=True, sort_keys=None,
                  stretch_bools=None, index_options=None, debounce_time=300, search_excludes=None, match_template=None,
-                 search_tags=None, scroll_speed=8, **kwargs):
+                 search_tags=None, scroll_speed=8, virtual=False, virtual_margin=2, chunk_size=500, **kwargs):
         ttk.Frame.__init__(self, master, **kwargs)
         self.master = master
         self.headers = headers.copy()
@@ -58,10 +84,19 @@ class Treelist(ttk.Frame):
 
         # A list of tags used to search, e.g. "respo:jinai" where "respo" is the tag
         self.search_tags = search_tags if search_tags else headers
+        self._parser = searchparser.SearchParser(self.search_tags)  # Keeps the compiled queries
 
-        # Units to scroll by when using the mouse wheel
+        # Units to scroll by when using the mouse wheel, minus the unit scrolled by the Treeview's own binding
         self.scroll_speed = max(scroll_speed - 1, 0)
 
+        # Only creates Treeview items for the visible rows (plus `virtual_margin`), the rest of the rows being kept in
+        # `_view` and recycled into those items when scrolling
+        self.virtual = virtual
+        self.virtual_margin = virtual_margin
+
+        # Number of rows created per idle callback by insert_many(), outside of virtual mode
+        self.chunk_size = chunk_size
+
         # Internal variables
         self._search_query = tk.StringVar()
         self._search_query.trace("w", lambda *x: self.search())
@@ -69,23 +104,42 @@ class Treelist(ttk.Frame):
         self._matches_label = tk.StringVar()  # Contains the number of matches (formatted) yielded by the search query
         self._debounce_after_id = None
         self._data = []  # Contains inserted values
-        self._row_count = 0  # Used for colored odd rows
+        self._index = searchindex.SearchIndex()  # Inverted index over `_data`, rebuilt lazily when `_data` changes
+        self._index_dirty = True
+        self._index_rows = []  # Rows of `_data` in the order they had when the index was built
+        self._positions = None  # {id(row): position in `_data`} once `_data` is sorted, None while in index order
+        self._sort_columns = []  # (column index, descending) of the columns `_data` is sorted by, first key first
+        # Tuple of sort columns -> rows of `_data` sorted by those columns, least recently used first, see sort()
+        self._sorted = collections.OrderedDict()
+        self._ranks = {}  # Column index -> {id(row): rank of the row's sort key among the column's keys}
+        self._row_count = 0  # Number of rows displayed, used for colored odd rows
         self._last_selected_item = None
+        self._view = []  # Virtual mode: rows currently displayed (all of `_data` or the search matches)
+        self._view_tags = []
+        self._first = 0  # Virtual mode: position in `_view` of the row shown by the first Treeview item
+        self._selection = {}  # Virtual mode: selected rows, including the ones scrolled out of the Treeview
+        self._extend_selection = False
+        self._render_id = None
+        self._pending = collections.deque()  # Rows prepared by insert_many() but not yet inserted into the Treeview
+        self._pending_after_id = None
 
         self._setup_widgets()
 
     def _setup_widgets(self):
         frame_tree = ttk.Frame(self)
         frame_tree.pack(fill='both', expand=True)
-        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical")
-        scrollbar.pack(side='right', fill='y')
+        self.scrollbar = ttk.Scrollbar(frame_tree, orient="vertical")
+        self.scrollbar.pack(side='right', fill='y')
 
         display = self.headers if self.index_show else self.headers[1:]
-        self.tree = ttk.Treeview(frame_tree, columns=self.headers, displaycolumns=display, show="headings",
-                                 height=self.height, selectmode="extended")
+        self.tree = _TreeScroll(frame_tree, columns=self.headers, displaycolumns=display, show="headings",
+                                height=self.height, selectmode="extended")
         self.tree.pack(side='top', fill='both', expand=True)
-        self.tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.configure(command=self.tree.yview)
+        self.scrollbar.configure(command=self.tree.yview)
+        if self.virtual:
+            self.tree.virtual_yview = self._virtual_yview
+        else:
+            self.tree.configure(yscrollcommand=self.scrollbar.set)
 
         # Tags
         self.tree.tag_configure("even_row", background=self.alt_colors[0])
@@ -94,6 +148,15 @@ class Treelist(ttk.Frame):
         # Bindings
         self.tree.bind('<Control-a>', lambda _: self.select_all())
         self.tree.bind("<MouseWheel>", self.mousewheel_handler)
+        self.tree.bind("<Shift-ButtonPress-1>", self._shift_click)
+        if self.virtual:
+            self.tree.bind("<Configure>", lambda _: self._schedule_render())
+            self.tree.bind("<ButtonPress-1>", self._track_modifiers, add="+")
+            self.tree.bind("<<TreeviewSelect>>", self._sync_selection, add="+")
+            self.tree.bind("<Up>", lambda _: self._move_focus(-1))
+            self.tree.bind("<Down>", lambda _: self._move_focus(1))
+            self.tree.bind("<Prior>", lambda _: self._move_focus(-self._visible_rows()))
+            self.tree.bind("<Next>", lambda _: self._move_focus(self._visible_rows()))
 
         self._build_tree()
 
@@ -104,16 +167,76 @@ class Treelist(ttk.Frame):
 
     def insert(self, values, update=True, tags=None):
         self._row_count += 1
+        orig_values = values
         values = list(values)
         tags = tags if tags else []
         if update:
-            values.insert(0, str(self._row_count))
+            values.insert(0, str(len(self._data) + 1))
             self._data.append(values)
+            self._data_changed()
+        if self.virtual:
+            self._view.append(values if update else orig_values)
+            self._view_tags.append(tags)
+            self._schedule_render()
+            return
         if not tags:
             tags.append(["even_row", "odd_row"][self._row_count % 2])
+        if self._pending:
+            self._pending.append((values, tags))  # Keeps the rows in order
+            return
         self.tree.insert('', 'end', values=values, tags=tags)
 
+    def insert_many(self, rows, update=True, tags=None):
+        # Same as calling insert() for each row, the Treeview items being created `chunk_size` at a time from idle
+        # callbacks so that the window stays responsive while thousands of rows are inserted
+        tags = tags if tags else [None] * len(rows)
+        prepared = []
+        for values in rows:
+            if update:
+                values = list(values)
+                values.insert(0, str(len(self._data) + 1))  # Numbered among all the rows, not only the displayed ones
+                self._data.append(values)
+            prepared.append(values)
+        if update:
+            self._data_changed()
+            if self._last_search_query:
+                # Rows added while the matches of a search are displayed only show up if they match it too
+                index = searchindex.SearchIndex()
+                index.build(prepared)
+                matches = index.search(self._parser.compile(self._last_search_query).terms)
+                prepared, tags = [prepared[i] for i in matches], [tags[i] for i in matches]
+                count = self._row_count + len(prepared)
+                self._matches_label.set(self.match_template.format(count, len(self._data)))
+        self._row_count += len(prepared)
+        if self.virtual:
+            self._view.extend(prepared)
+            self._view_tags.extend(tags)
+            self._schedule_render()
+            return
+        for row, (values, row_tags) in enumerate(zip(prepared, tags), self._row_count - len(prepared) + 1):
+            self._pending.append((values, row_tags or [["even_row", "odd_row"][row % 2]]))
+        if self._pending and self._pending_after_id is None:
+            self._pending_after_id = self.after_idle(self._insert_pending, self.chunk_size)
+
+    def _insert_pending(self, count=None):
+        self._pending_after_id = None
+        count = len(self._pending) if count is None else min(count, len(self._pending))
+        for _ in range(count):
+            values, tags = self._pending.popleft()
+            self.tree.insert('', 'end', values=values, tags=tags)
+        if self._pending:
+            self._pending_after_id = self.after_idle(self._insert_pending, self.chunk_size)
+
+    def flush(self):
+        # Inserts the pending rows right away, for the code that needs every item of the Treeview
+        if self._pending_after_id is not None:
+            self.after_cancel(self._pending_after_id)
+        self._insert_pending()
+
     def delete_selection(self):
+        if self.virtual:
+            return self._virtual_delete_selection()
+        self.flush()
         selection = self.tree.selection()
         index = 0
         for item in selection:
@@ -124,29 +247,53 @@ class Treelist(ttk.Frame):
             self._data.remove(values)
             self.tree.delete(item)
             self._row_count -= 1
+        self._data_changed()
         return index
 
     def clear(self, keep_data=False):
         self._row_count = 0
-        self.tree.delete(*self.tree.get_children())
+        if self._pending_after_id is not None:
+            self.after_cancel(self._pending_after_id)
+            self._pending_after_id = None
+        self._pending.clear()
+        if self.virtual:
+            # Items are kept so that _render() can recycle them
+            self._view, self._view_tags = [], []
+            self._first = 0
+            self._selection = {}
+            self._schedule_render()
+        else:
+            self.tree.delete(*self.tree.get_children())
         if not keep_data:
             del self._data[:]
+            self._data_changed()
 
     def scroll_up(self, event=None):
         self.update()
         self.tree.yview_moveto(0)
 
     def scroll_down(self, event=None):
+        self.flush()
         self.update()
         self.tree.yview_moveto(1)
 
     def focus_index(self, index):
+        if self.virtual:
+            if not 0 <= index < len(self._view):
+                return
+            visible = self._visible_rows()
+            if not self._first <= index < self._first + visible:
+                self._first = index if index < self._first else index - visible + 1
+            self._render()
+            index -= self._first
+        self.flush()
         rows = self.tree.get_children()
         if index < len(rows):
             item = rows[index]
             self.focus_item(item)
 
     def focus_item(self, item):
+        self._extend_selection = False
         try:
             self.focus_force()
             self.tree.selection_set((item,))
@@ -155,20 +302,69 @@ class Treelist(ttk.Frame):
         except tk.TclError:
             pass
 
-    def sort(self, col, descending):
+    def sort(self, col, descending, extend=False):
+        # With `extend`, the column is added to the current sort columns as the next key, or its direction is reversed
+        # if it's already one of them
         if self.sortable:
-            tree_data = [(self.tree.set(child, col), self.tree.set(child, 0), child) for child in
-                         self.tree.get_children('')]
             index = self.headers.index(col)
-            tree_data.sort(reverse=descending, key=lambda x: (self.sort_keys[index](x), int(x[1])))
-            self._data.sort(reverse=descending, key=lambda x: (self.sort_keys[index]([x[index]]), int(x[0])))
-            for index, item in enumerate(tree_data):
-                self.tree.move(item[2], '', index)
-                self.tree.item(item[2], tags=[["even_row", "odd_row"][(index + 1) % 2]])
+            if not extend:
+                self._sort_columns = [(index, descending)]
+            elif index in dict(self._sort_columns):
+                self._sort_columns = [(i, not d if i == index else d) for i, d in self._sort_columns]
+            else:
+                self._sort_columns.append((index, descending))
+            self._data[:] = self._sorted_rows(tuple(self._sort_columns))
+            # The rows themselves didn't change: the index is kept, its matches being put back in the new order
+            self._positions = {}
             # Switch heading command to reverse the sort next time
+            descending = dict(self._sort_columns)[index]
             self.tree.heading(col, command=lambda col=col: self.sort(col, not descending))
-            # In case the user is in the middle of a search
-            self.search()
+            # Makes search() display `_data` in its new order, or the matches of the current search in that order
+            self._last_search_query = None
+            self.search(debounced=True)
+
+    def _sorted_rows(self, columns):
+        # `columns` is a tuple of (column index, descending). Since the index column breaks ties, reversing every
+        # direction reverses the order: only the order whose first column is ascending is kept
+        flip = columns[0][1]
+        if flip:
+            columns = tuple((index, not descending) for index, descending in columns)
+        rows = self._sorted.get(columns)
+        if rows is None:
+            keys = [(self._column_ranks(index), -1 if descending else 1) for index, descending in columns]
+            rows = sorted(self._data, key=lambda x: tuple(sign * ranks[id(x)] for ranks, sign in keys) + (int(x[0]),))
+            self._sorted[columns] = rows
+            if len(self._sorted) > Treelist.SORT_CACHE_SIZE:
+                self._sorted.popitem(last=False)
+        else:
+            self._sorted.move_to_end(columns)
+        return rows[::-1] if flip else list(rows)
+
+    def _column_ranks(self, index):
+        # Rank of each row once sorted by the `sort_keys` of the column, equal keys sharing the same rank. Ranks being
+        # integers, they combine into composite keys whatever the direction of each column
+        ranks = self._ranks.get(index)
+        if ranks is None:
+            key = self.sort_keys[index]
+            keys = [key([x[index], x]) for x in self._data]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            ranks = {}
+            rank = 0
+            for n, i in enumerate(order):
+                if n and keys[i] != keys[order[n - 1]]:
+                    rank = n
+                ranks[id(self._data[i])] = rank
+            self._ranks[index] = ranks
+        return ranks
+
+    def _shift_click(self, event):
+        # Shift+click on a heading sorts by that column in addition to the current ones
+        if self.tree.identify_region(event.x, event.y) == "heading":
+            col = self.tree.column(self.tree.identify_column(event.x), option="id")
+            self.sort(col, True, extend=True)
+            return "break"
+        if self.virtual:
+            self._track_modifiers(event)
 
     def search(self, query=None, debounced=False):
         if self.debounce_time > 0 and not debounced:
@@ -187,42 +383,171 @@ class Treelist(ttk.Frame):
             return
 
         logger.debug("Searching for '{}'".format(query))
-        self.clear(keep_data=True)
         if query == "":
-            for values in self._data:
-                self.insert(values, update=False)
+            self._show(self._data)
             self._matches_label.set('')
         else:
-            matches = 0
-            notag, *tags = searchparser.SearchParser(self.search_tags).parse(query)
-            for values in self._data:
-                for tag in tags:
-                    if not tag.content.strip().lower() in str(values[tag.index]).lower():
-                        break
-                else:
-                    if notag.content:
-                        for item in values:
-                            content = notag.content.rstrip() if tags else notag.content
-                            if content.lower() in str(item).lower():
-                                self.insert(values, update=False)
-                                matches += 1
-                                break
-                    else:
-                        self.insert(values, update=False)
-                        matches += 1
-            self._matches_label.set(self.match_template.format(matches, len(self._data)))
+            rows = self.build_index().query(self._parser.compile(query))
+            self._show(self._matching_rows(rows))
+            self._matches_label.set(self.match_template.format(len(rows), len(self._data)))
 
         self._last_search_query = query
         self.scroll_up()
 
+    def _matching_rows(self, rows):
+        # Rows of `_data` at the positions `rows` of the index, in the current order of `_data`
+        matches = [self._index_rows[row] for row in rows]
+        if self._positions is not None:
+            if not self._positions:
+                self._positions.update((id(row), i) for i, row in enumerate(self._data))
+            matches.sort(key=lambda row: self._positions[id(row)])
+        return matches
+
+    def _data_changed(self):
+        # Rows were added, removed or edited: the search index and the sorted orders are outdated
+        self._index_dirty = True
+        self._sorted.clear()
+        self._ranks.clear()
+
+    def build_index(self):
+        # The postings are built by a background thread, queries scanning the casefolded columns until they are ready
+        if self._index_dirty:
+            self._index.build(self._data)
+            self._index_dirty = False
+            self._index_rows = list(self._data)
+            self._positions = None
+            threading.Thread(target=self._index.build_postings, daemon=True).start()
+        return self._index
+
+    def _show(self, rows):
+        self.clear(keep_data=True)
+        if self.virtual:
+            self._view = list(rows)
+            self._view_tags = [None] * len(self._view)
+            self._row_count = len(self._view)
+        else:
+            self.insert_many(rows, update=False)
+
+    def selected_rows(self):
+        if self.virtual:
+            return [row for row in self._view if id(row) in self._selection]
+        rows = []
+        for item in self.tree.selection():
+            values = self.tree.item(item)['values']
+            values[0] = str(values[0])  # Treeviews force str to int if it's a digit
+            rows.append(values)
+        return rows
+
     def select_all(self):
+        if self.virtual:
+            self._selection = {id(row): row for row in self._view}
+            self._render()
+        self.flush()
         self.tree.selection_set(self.tree.get_children())
 
     def deselect_all(self):
+        if self.virtual:
+            self._selection = {}
         self.tree.selection_remove(self.tree.get_children())
 
+    def _visible_rows(self):
+        # Number of rows fully visible in the Treeview, measured on its first item once it has been drawn
+        items = self.tree.get_children()
+        if items:
+            bbox = self.tree.bbox(items[0])
+            if bbox and bbox[3] > 0:
+                return max(1, (self.tree.winfo_height() - bbox[1]) // bbox[3])
+        return self.height
+
+    def _schedule_render(self):
+        if self._render_id is None:
+            self._render_id = self.after_idle(self._render)
+
+    def _render(self):
+        if self._render_id is not None:
+            self.after_cancel(self._render_id)
+            self._render_id = None
+        total = len(self._view)
+        visible = self._visible_rows()
+        self._first = max(0, min(self._first, total - visible))
+        rows = self._view[self._first:self._first + visible + self.virtual_margin]
+        items = self.tree.get_children()
+        selected = []
+        for i, values in enumerate(rows):
+            position = self._first + i
+            tags = self._view_tags[position] or [["even_row", "odd_row"][(position + 1) % 2]]
+            if i < len(items):
+                item = items[i]
+                self.tree.item(item, values=values, tags=tags)
+            else:
+                item = self.tree.insert('', 'end', values=values, tags=tags)
+            if id(values) in self._selection:
+                selected.append(item)
+        if len(items) > len(rows):
+            self.tree.delete(*items[len(rows):])
+        if set(self.tree.selection()) != set(selected):
+            self.tree.selection_set(selected)
+        ttk.Treeview.yview_moveto(self.tree, 0)  # The recycled items must never scroll by themselves
+        if total:
+            self.scrollbar.set(self._first / total, min(self._first + visible, total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _virtual_yview(self, *args):
+        visible = self._visible_rows()
+        if args[0] == "moveto":
+            self._first = round(float(args[1]) * len(self._view))
+        elif args[0] == "scroll":
+            step = visible if args[2] == "pages" else 1
+            self._first += int(args[1]) * step
+        self._render()
+
+    def _move_focus(self, delta):
+        items = self.tree.get_children()
+        focus = self.tree.focus()
+        position = self._first + items.index(focus) if focus in items else self._first
+        self.focus_index(max(0, min(position + delta, len(self._view) - 1)))
+        return "break"
+
+    def _track_modifiers(self, event):
+        # Ctrl+click and Shift+click add to the selection, a plain click replaces it
+        self._extend_selection = bool(event.state & 0x0005)
+
+    def _sync_selection(self, event=None):
+        items = self.tree.get_children()
+        window = self._view[self._first:self._first + len(items)]
+        selected = set(self.tree.selection())
+        in_window = {id(row): row for item, row in zip(items, window) if item in selected}
+        window_ids = {id(row) for row in window}
+        if in_window.keys() == self._selection.keys() & window_ids:
+            return  # Selection restored by _render()
+        if self._extend_selection:
+            for key in window_ids:
+                self._selection.pop(key, None)
+        else:
+            self._selection = {}
+        self._selection.update(in_window)
+
+    def _virtual_delete_selection(self):
+        rows = self.selected_rows()
+        index = self._view.index(rows[-1]) if rows else 0
+        deleted = set(self._selection)
+        self._data[:] = [row for row in self._data if id(row) not in deleted]
+        kept = [i for i, row in enumerate(self._view) if id(row) not in deleted]
+        self._view = [self._view[i] for i in kept]
+        self._view_tags = [self._view_tags[i] for i in kept]
+        self._row_count = len(self._view)
+        self._selection = {}
+        self._data_changed()
+        self._render()
+        return index
+
     def mousewheel_handler(self, event):
         direction = 1
         if event.delta > 0:
             direction = -1
+        if self.virtual:
+            # Tk's own binding would scroll the recycled items themselves, away from `_first`
+            self.tree.yview_scroll((self.scroll_speed + 1) * direction, "units")
+            return "break"
         self.tree.yview_scroll(self.scroll_speed * direction, "units")
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 # !python3
 
+import gzip
+import hashlib
 import json
 import logging
 import os
+import tarfile
 import threading
-import time
+import zlib
 import tkinter.ttk as ttk
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urljoin
 
 import requests
 from requests import HTTPError, Timeout, RequestException
+from requests.adapters import HTTPAdapter
 
 import utils
 from _meta import __version__
@@ -21,9 +26,31 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Bytes already present locally that are requested again when only fetching the end of an archive file, to check that
+# the local file lines up with the remote one
+RANGE_OVERLAP = 64
+BLOCK_SIZE = 64 * 1024
+
+
+class Transfer():
+    # Bytes received so far by a download, read from the Tk thread to drive the progress bar
+    def __init__(self, response, weight=1):
+        self.response = response
+        self.length = int(response.headers.get("Content-Length") or 0)
+        self.received = 0
+        self.weight = weight  # Number of archive files the download accounts for
+
+    def update(self):
+        self.received = self.response.raw.tell()
+
+    def done(self):
+        # Part of the `weight` files downloaded so far
+        return self.weight * min(self.received / self.length, 1) if self.length else 0
+
 
 class Updater(ttk.Frame):
-    def __init__(self, master, *, button_text, archives, callback, timeout=8, statusbar, **kwargs):
+    def __init__(self, master, *, button_text, archives, callback, timeout=8, statusbar,
+                 base_url="https://respomap.herokuapp.com/", workers=4, **kwargs):
         super().__init__(master, **kwargs)
         self.master = master
         self.button_text = button_text
@@ -31,14 +58,22 @@ class Updater(ttk.Frame):
         self.callback = callback
         self.timeout = timeout
         self.statusbar = statusbar
-        self.base_url = "https://respomap.herokuapp.com/"
+        self.base_url = base_url
         self.meta_url = urljoin(self.base_url, "/meta.json")
         self.meta = None
         self.download_thread = None
         self.running = threading.Event()
         self.result = None
+        self.failed = 0
+        self.progress = None  # [done, total, filename] updated by the download threads, displayed by _check_result
+        self.transfers = {}  # {name: Transfer} of the downloads in progress
         self._check_result_id = None
-        self.progressbar_step = 10
+        # Archive files are downloaded concurrently over a pool of kept-alive connections
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.setup()
 
     def setup(self):
@@ -84,10 +119,10 @@ class Updater(ttk.Frame):
             self.download_thread.start()
             self._check_result_id = self.after(100, self._check_result)
 
-    def _download_file(self, url, *, timeout):
+    def _download_file(self, url, *, timeout, headers=None, stream=False):
         logger.info(f"Downloading {url}")
         try:
-            r = requests.get(url, timeout=timeout)
+            r = self.session.get(url, timeout=timeout, headers=headers, stream=stream)
             r.raise_for_status()
             return r
         except HTTPError as e:
@@ -102,58 +137,249 @@ class Updater(ttk.Frame):
 
     def download(self):
         logger.debug("Starting download thread")
-        local_hash = self.archives.get_hash()
         target_dir = self.archives.dir_path
-        logger.debug(f"Local hash is {local_hash}")
         r = self._download_file(self.meta_url, timeout=self.timeout)
         if r and self.running.is_set():
             self.meta = json.loads(r.text)
-            remote_hash = self.meta["archives"]["hash"]
+            # Servers publishing the hash of each file also publish their combination ("root"), older ones only
+            # publish the hash of the content of all the files
+            if "root" in self.meta["archives"]:
+                local_hash, remote_hash = self.archives.get_hash(), self.meta["archives"]["root"]
+            else:
+                local_hash, remote_hash = self.archives.get_legacy_hash(), self.meta["archives"]["hash"]
+            logger.debug(f"Local hash is {local_hash}")
             logger.debug(f"Remote hash is {remote_hash}")
+            result = 0
             if local_hash != remote_hash:
                 logger.info("Archives update found")
-                if utils.create_directory(target_dir):
-                    logger.info(f"Created directory '{target_dir}'")
-                self.progressbar.configure(maximum=len(self.meta["archives"]["files"] * self.progressbar_step))
-                downloaded = 0
-                i = 0
-                while i < len(self.meta["archives"]["files"]) and self.running.is_set():
-                    file = self.meta["archives"]["files"][i]
-                    filename = os.path.basename(file)
-                    self.set_pbar_text(filename)
-                    url = urljoin(self.base_url, file)
-                    r = self._download_file(url, timeout=self.timeout)
-                    if not r:
-                        break
-                    try:
-                        with open(os.path.join(target_dir, filename), "w", encoding="utf-8") as f:
-                            f.write(r.text)
-                        downloaded += 1
-                        if not self.running.is_set():
-                            break
-                        for _ in range(self.progressbar_step):
-                            self.progressbar.step()
-                            self.progressbar.update()
-                            time.sleep(0.1 / self.progressbar_step)
-                    except OSError as e:
-                        logger.error(e)
-                        d = utils.get_app_directory()
-                        self.statusbar.set(f"Problème d'écriture sur le disque, voir logs dans {d}", clear_after=0)
-                        break
-                    i += 1
-                self.result = downloaded
+                try:
+                    result = self._update_files(target_dir)
+                except (OSError, ValueError, RequestException) as e:
+                    logger.error(e)
+                    self.failed += 1
             else:
-                self.result = -1  # Sentinel value
                 logger.info("Archives already up to date")
+            # Only set once every file is done, for _check_result() to tell success from failure
+            self.result = result
 
         logger.debug("Stopping download thread")
 
+    def _update_files(self, target_dir):
+        # Returns the number of files downloaded, counting the files that couldn't be in `failed`
+        result = 0
+        if utils.create_directory(target_dir):
+            logger.info(f"Created directory '{target_dir}'")
+        files = self.meta["archives"]["files"]
+        # Files whose hash is listed in meta.json are only downloaded when they differ from the local copy
+        hashes = self.meta["archives"].get("hashes", {})
+        local_hashes = self.archives.file_hashes()
+        todo = [file for file in files
+                if hashes.get(file) is None or hashes[file] != local_hashes.get(os.path.basename(file))]
+        up_to_date = len(files) - len(todo)
+        self.progress = [up_to_date, len(files), ""]
+        bundle = self.meta["archives"].get("bundle")
+        if bundle and len(files) > 1 and len(todo) == len(files):
+            # Nothing is up to date (first run): a single compressed tarball of all the years is enough
+            expected = {os.path.basename(file): hashes.get(file) for file in todo}
+            extracted = self._download_bundle(urljoin(self.base_url, bundle), expected)
+            todo = [file for file in todo if os.path.basename(file) not in extracted]
+            result += len(extracted)
+            self.progress[0] += len(extracted)
+        validators = self._load_validators()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._update_file, file, validators, hashes.get(file),
+                                       local_hashes.get(os.path.basename(file))): file for file in todo}
+            for future in as_completed(futures):
+                try:
+                    downloaded = future.result()
+                except (OSError, ValueError, RequestException) as e:
+                    logger.error(f"{e} File: {futures[future]}")
+                    downloaded = None
+                if downloaded is None:
+                    self.failed += 1
+                elif downloaded:
+                    result += 1
+                self.progress[0] += 1
+        self._save_validators(validators)
+        logger.info(f"Downloaded {result} files, {up_to_date} already up to date")
+        return result
+
+    def _update_file(self, file, validators, remote_hash=None, local_hash=None):
+        # Returns True if the file was downloaded, False if the server says it didn't change and None on failure
+        if not self.running.is_set():
+            return None
+        filename = os.path.basename(file)
+        path = os.path.join(self.archives.dir_path, filename)
+        self.progress[2] = filename
+        r = None
+        if remote_hash and os.path.isfile(path):
+            # Archive files only grow: try fetching what was appended to the remote file since the local copy
+            r = self._download_range(urljoin(self.base_url, file), path, remote_hash)
+        # Gzipped variant of the file, decompressed while it's written to disk
+        compressed = self.meta["archives"].get("gzip", {}).get(file) if r is None else None
+        source = compressed if compressed else file
+        key = os.path.basename(source)  # Validators are those of the resource actually requested
+        # A local file known to differ from the remote one (e.g. corrupted) is requested without conditions, the server
+        # answering 304 as long as the remote file itself didn't change
+        differs = bool(remote_hash) and local_hash != remote_hash
+        if r is None:
+            headers = {}
+            validator = validators.get(key) if os.path.isfile(path) and not differs else None
+            if validator:
+                if validator.get("etag"):
+                    headers["If-None-Match"] = validator["etag"]
+                if validator.get("last_modified"):
+                    headers["If-Modified-Since"] = validator["last_modified"]
+            r = self._download_file(urljoin(self.base_url, source), timeout=self.timeout, headers=headers,
+                                    stream=True)
+            if r is not None and r.status_code == 304 and differs:
+                r.close()
+                r = self._download_file(urljoin(self.base_url, source), timeout=self.timeout, stream=True)
+        if r is None:
+            return None
+        if r.status_code == 304:
+            logger.debug(f"'{filename}' not modified")
+            return False
+        if r.status_code != 206:
+            self.transfers[filename] = transfer = Transfer(r)
+            try:
+                if compressed:
+                    r.raw.decode_content = True  # Undoes any Content-Encoding, the file itself still being gzipped
+                    written = self._write_file(path, _blocks(gzip.GzipFile(fileobj=r.raw)), remote_hash, transfer)
+                else:
+                    # Written as is so that the local file hashes like the remote one
+                    written = self._write_file(path, r.iter_content(BLOCK_SIZE), remote_hash, transfer)
+            finally:
+                del self.transfers[filename]
+                r.close()
+            if not written:
+                return None
+        validators[key] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        return True
+
+    def _write_file(self, path, blocks, remote_hash=None, transfer=None):
+        # Writes `blocks` to a temporary file replacing `path` once complete, if its content matches `remote_hash`
+        tmp_path = f"{path}.tmp"
+        md5 = hashlib.md5()
+        try:
+            try:
+                with open(tmp_path, "wb") as f:
+                    for block in blocks:
+                        md5.update(block)
+                        f.write(block)
+                        if transfer:
+                            transfer.update()
+            except (EOFError, zlib.error, RequestException) as e:
+                logger.error(f"{e} File: {path}")
+                os.remove(tmp_path)
+                return False
+            if remote_hash and md5.hexdigest() != remote_hash:
+                logger.error(f"Hash mismatch for '{path}'")
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(e)
+            d = utils.get_app_directory()
+            self.statusbar.set(f"Problème d'écriture sur le disque, voir logs dans {d}", clear_after=0)
+            return False
+        return True
+
+    def _download_bundle(self, url, expected):
+        # Extracts the files of the tarball at `url` whose name is a key of `expected` ({filename: hash}) as they are
+        # received. Returns the names of the extracted files.
+        extracted = set()
+        r = self._download_file(url, timeout=self.timeout, stream=True)
+        if r is None:
+            return extracted
+        r.raw.decode_content = True
+        self.transfers[url] = transfer = Transfer(r, weight=len(expected))
+        try:
+            with r, tarfile.open(fileobj=r.raw, mode="r|gz") as tar:
+                for member in tar:
+                    name = os.path.basename(member.name)
+                    if not member.isfile() or name not in expected or not self.running.is_set():
+                        continue
+                    self.progress[2] = name
+                    path = os.path.join(self.archives.dir_path, name)
+                    if self._write_file(path, _blocks(tar.extractfile(member)), expected[name], transfer):
+                        extracted.add(name)
+        except (tarfile.TarError, EOFError, zlib.error, OSError, RequestException) as e:
+            logger.error(f"{e} URL: {url}")
+        finally:
+            del self.transfers[url]
+        logger.info(f"Extracted {len(extracted)} files from {url}")
+        return extracted
+
+    def _download_range(self, url, path, remote_hash):
+        # Rewrites `path` with the end of the remote file appended and returns the 206 response. A server ignoring the
+        # range sends the whole file: its response is returned unread, for the caller to write it like any download.
+        # Returns None if the whole file has to be requested.
+        size = os.path.getsize(path)
+        overlap = min(size, RANGE_OVERLAP)
+        if overlap == 0:
+            return None
+        start = size - overlap
+        try:
+            r = self.session.get(url, timeout=self.timeout, headers={"Range": f"bytes={start}-"}, stream=True)
+        except RequestException as e:
+            logger.debug(f"{e} URL: {url}")
+            return None
+        content_range = r.headers.get("Content-Range", "")
+        if r.status_code == 200 and not content_range:
+            return r
+        with r:
+            if r.status_code != 206 or not content_range.startswith(f"bytes {start}-"):
+                return None
+            try:
+                content = r.content
+            except RequestException as e:
+                logger.debug(f"{e} URL: {url}")
+                return None
+        with open(path, "rb") as f:
+            data = f.read()
+        if not content.startswith(data[start:]):
+            logger.info(f"'{os.path.basename(path)}' differs from the remote file, downloading it again")
+            return None
+        appended = content[overlap:]
+        # Written to a temporary file replacing the archive only if the result hashes like the remote file
+        if not self._write_file(path, [data, appended], remote_hash):
+            logger.info(f"Couldn't append to '{os.path.basename(path)}', downloading it again")
+            return None
+        logger.info(f"Appended {len(appended)} bytes to '{os.path.basename(path)}'")
+        return r
+
+    @property
+    def validators_path(self):
+        # HTTP validators (ETag, Last-Modified) of the downloaded archive files
+        return self.archives.dir_path.parent / "archives.etags"
+
+    def _load_validators(self):
+        try:
+            with open(self.validators_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_validators(self, validators):
+        try:
+            with open(self.validators_path, "w", encoding="utf-8") as f:
+                json.dump(validators, f, indent=4)
+        except OSError as e:
+            logger.error(e)
+
     def _check_result(self):
         if self.download_thread.is_alive():
+            if self.progress:
+                # Files still downloading count for the part of their bytes already received
+                done, total, filename = self.progress
+                done += sum(transfer.done() for transfer in list(self.transfers.values()))
+                self.progressbar.configure(maximum=total, value=done)
+                self.set_pbar_text(f"{filename} ({100 * done / total:.0f} %)" if total else filename)
             self._check_result_id = self.after(100, self._check_result)
             return
 
-        if self.meta is None or self.result is None or (0 <= self.result < len(self.meta["archives"]["files"])):
+        if self.meta is None or self.result is None or self.failed:
             self.icon.select("fail", hide_delay=3000)
         else:
             self.icon.select("success", hide_delay=3000)
@@ -166,7 +392,6 @@ class Updater(ttk.Frame):
 
     def stop(self):
         self.running.clear()
-        self.result = None
         if self._check_result_id:
             self.after_cancel(self._check_result_id)
             self._check_result_id = None
@@ -178,6 +403,9 @@ class Updater(ttk.Frame):
             self.icon.hide()
         if self.download_thread:
             self.download_thread.join()
+        self.result = None
+        self.failed = 0
+        self.progress = None
 
     def check_software_update(self):
         if self.meta is None:
@@ -200,4 +428,9 @@ class Updater(ttk.Frame):
 
     def destroy(self):
         self.stop()
+        self.session.close()
         super().destroy()
+
+
+def _blocks(fileobj):
+    return iter(lambda: fileobj.read(BLOCK_SIZE), b"")
@@ -5,6 +5,7 @@ import json
 import logging
 import os
 import platform
+import threading
 import tkinter as tk
 import tkinter.filedialog as fdialog
 import tkinter.messagebox as mbox
@@ -13,7 +14,8 @@ import tkinter.ttk as ttk
 import pyperclip
 
 import archives
-import signalement
+import journal
+import sigfile
 import sigparser
 import utils
 from _meta import __appname__, __version__
@@ -48,6 +50,9 @@ class RespoTool(tk.Tk):
             self.contact = json.load(f)
         self.signalements = []
         self.archives = archives.Archives(archives_dir, archives_pattern)
+        self.journal = journal.Journal(lambda: self.signalements)
+        self._archives_thread = None
+        self._check_archives_id = None
 
         # Rendering
         fix_treeview()
@@ -63,10 +68,12 @@ class RespoTool(tk.Tk):
             logging.error(e)
 
         # Imports
-        if self.auto_import:
-            if self.session_path and os.path.exists(self.session_path):
+        if self.auto_import and self.session_path:
+            if os.path.exists(self.session_path) or os.path.exists(self.session_path + ".journal"):
                 self.import_save(self.session_path)
-        self.archives.open()
+            else:
+                self.journal.open(self.session_path)
+        self.load_archives()
 
         # Bindings
         self.bind("<Control-s>", lambda _: self.export_save())
@@ -147,7 +154,7 @@ class RespoTool(tk.Tk):
         headers = ["Date", "Auteur", "Code", "Flag", "Description", "Statut", "Respomap(s)"]
         column_widths = [55, 85, 100, 80, 400, 350, 100]
         sort_keys = [
-            lambda x: (int(x[0].split("/")[1]), int(x[0].split("/")[0])),
+            lambda x: tuple(int(n) for n in reversed(x[0].split("/")[:2])),  # dd/mm
             lambda x: x[0].lower(),
             lambda x: x[0].lower(),
             lambda x: x[0].lower(),
@@ -167,6 +174,7 @@ class RespoTool(tk.Tk):
         search_tags = ["num", "date", "auteur", "code", "flag", "desc", "statut", "respo"]
         self.tree_sig = siglist.Siglist(self.main_frame, signalements=self.signalements, archives=self.archives,
                                         respomap_widget=self.dropdown_respo, statusbar=self.statusbar,
+                                        journal=self.journal,
                                         headers=headers, sort_keys=sort_keys, stretch_bools=stretch_bools, height=20,
                                         index_options=index_options, sortable=False, column_widths=column_widths,
                                         match_template="{} sur {}", search_excludes=exclude, search_tags=search_tags)
@@ -216,12 +224,31 @@ class RespoTool(tk.Tk):
             self.button_generate_mp.configure(state="disabled")
             self.button_archive_selection.configure(state="enabled")
 
+    def load_archives(self):
+        # The archives are only needed to spot duplicates and to archive, so the session is usable while they load
+        self.tree_sig.archives_loaded = False
+        self.statusbar.set("Chargement des archives...", clear_after=0)
+        self._archives_thread = threading.Thread(target=self.archives.open, daemon=True)
+        self._archives_thread.start()
+        self._check_archives_id = self.after(100, self._check_archives)
+
+    def _check_archives(self):
+        if self._archives_thread.is_alive():
+            self._check_archives_id = self.after(100, self._check_archives)
+            return
+
+        self._check_archives_id = None
+        self.tree_sig.archives_loaded = True
+        self.tree_sig.update_duplicates()
+        self.statusbar.set("{} signalements archivés chargés.".format(len(self.archives)))
+
     def new_file(self):
         filename = fdialog.askopenfilename(filetypes=(("Text Files", "*.txt"), ("All Files", "*.*")))
         if filename:
             with open(filename, "r", encoding="utf-8") as f:
                 self.signalements = sigparser.parse(f.read())
             if self.signalements:
+                self.journal.detach()  # Nothing is saved until the new session is exported
                 self.refresh(scroll="up")
                 self.statusbar.set(
                     "Nouvelle session depuis '{}', {} signalements importés.".format(filename, len(self.signalements))
@@ -230,6 +257,7 @@ class RespoTool(tk.Tk):
     def new_clipboard(self):
         self.signalements = sigparser.parse(pyperclip.paste())
         if self.signalements:
+            self.journal.detach()  # Nothing is saved until the new session is exported
             self.refresh(scroll="up")
             self.statusbar.set(
                 "Nouvelle session depuis le presse-papiers, {} signalements importés.".format(len(self.signalements))
@@ -242,48 +270,57 @@ class RespoTool(tk.Tk):
                 signalements = sigparser.parse(f.read())
             if signalements:
                 self.signalements.extend(signalements)
+                saved = self.journal.append(signalements)
                 self.refresh(scroll="down", focus_index=-len(signalements))
                 self.statusbar.set(
                     "{} signalements ajoutés à la session courante depuis '{}'.".format(len(signalements), filename)
                 )
+                if not saved:
+                    self.journal_error()
 
     def append_clipboard(self):
         signalements = sigparser.parse(pyperclip.paste())
         if signalements:
             self.signalements.extend(signalements)
+            saved = self.journal.append(signalements)
             self.refresh(scroll="down", focus_index=-len(signalements))
             self.statusbar.set(
                 "{} signalements ajoutés à la session courante depuis le presse-papiers.".format(len(signalements))
             )
+            if not saved:
+                self.journal_error()
 
     def generate_contact_message(self):
         sig = self.tree_sig.get_selected_sigs()[0]
         template = "\n".join(self.contact["message"])
-        message = template.format(**sig.__dict__)
+        message = template.format(**sig.asdict())
         pyperclip.copy(message)
         self.statusbar.set("MP copié dans le presse-papiers.")
 
     def archive_selection(self):
+        if not self.tree_sig.archives_loaded:
+            self.statusbar.set("Chargement des archives en cours, veuillez réessayer dans un instant.")
+            return
         indexes = self.tree_sig.selection_indexes()
         if utils.validate_indexes(indexes):
-            archived = []
             msg = "Êtes-vous sûr de vouloir archiver {} signalements ?".format(len(indexes))
             if mbox.askokcancel("Archiver sélection", msg, parent=self):
-                for i in indexes:
-                    sig = self.signalements[i]
-                    if "todo" in sig.statut:
-                        msg = "{} signalements sur {} ont été archivés car il en reste un non traité :\n{}"
-                        mbox.showwarning("Archivage incomplet", msg.format(i, indexes[-1] + 1, sig.sigmdm()),
-                                         parent=self)
-                        break
-                    elif self.archives.archive_sig(sig):
-                        archived.append(sig)
-                    else:
-                        break
+                selection = [self.signalements[i] for i in indexes]
+                todo = next((i for i, sig in enumerate(selection) if "todo" in sig.statut), None)
+                archived = self.archives.archive_many(selection[:todo])
+                if todo is not None and len(archived) == todo:
+                    msg = "{} signalements sur {} ont été archivés car il en reste un non traité :\n{}"
+                    msg = msg.format(todo, indexes[-1] + 1, selection[todo].sigmdm())
+                    mbox.showwarning("Archivage incomplet", msg, parent=self)
                 if archived:
+                    archived = set(archived)
+                    removed = [i for i in reversed(range(len(self.signalements))) if self.signalements[i] in archived]
                     self.signalements = [sig for sig in self.signalements if sig not in archived]
+                    saved = self.journal.delete(removed, op="archive")
                     self.refresh(archives=True, scroll="up")
                     self.statusbar.set("{} signalements archivés.".format(len(archived)))
+                    if not saved:
+                        self.journal_error()
         else:
             msg = ("Votre sélection doit être d'un seul bloc (pas de trous) et doit commencer par le premier " +
                    "signalement afin de conserver l'ordre des archives.")
@@ -296,14 +333,21 @@ class RespoTool(tk.Tk):
             filename = fdialog.asksaveasfilename(initialdir="saves", initialfile="session", defaultextension=".sig")
         if filename:
             logging.info("Exporting '{}'".format(filename))
-            dicts = []
-            for i, sig in enumerate(self.signalements):
-                d = sig.ordered_dict()
-                d.update({"#": i + 1})
-                d.move_to_end("#", last=False)
-                dicts.append(d)
-            with open(filename, "w", encoding="utf-8") as f:
-                f.write(json.dumps(dicts, indent=4, ensure_ascii=False))
+            if self.journal.path and os.path.abspath(filename) == os.path.abspath(self.journal.path):
+                if not self.journal.compact(progress=self.progress_handler("Export")):
+                    self.journal_error()
+                    return
+            else:
+                try:
+                    sigfile.write(filename, self.signalements, progress=self.progress_handler("Export"))
+                except OSError as e:
+                    logging.error(e)
+                    self.statusbar.set(journal.ERROR_MESSAGE.format(filename), clear_after=0)
+                    return
+                if self.journal.path is None:
+                    # A new session is saved from then on in the file it was exported to
+                    self.session_path = filename
+                    self.journal.open(filename)
             self.statusbar.set("{} signalements exportés dans '{}'.".format(len(self.signalements), filename))
 
     def import_save(self, path=None):
@@ -315,14 +359,28 @@ class RespoTool(tk.Tk):
         if filename:
             logging.info("Importing '{}'".format(filename))
             self.session_path = filename
-            with open(filename, "r", encoding="utf-8") as f:
-                dicts = json.load(f)
-            del self.signalements[:]
-            for d in dicts:
-                self.signalements.append(signalement.Signalement.from_dict(d))
+            self.journal.open(filename)
+            signalements = []
+            if os.path.exists(filename):
+                signalements.extend(sigfile.read(filename, progress=self.progress_handler("Import")))
+            self.journal.replay(signalements)
+            self.signalements[:] = signalements
             self.refresh()
             self.statusbar.set("{} signalements importés depuis '{}'.".format(len(self.signalements), filename))
 
+    def progress_handler(self, action):
+        def progress(done, total):
+            text = "{} en cours... {} signalements".format(action, done)
+            if total:
+                text += " sur {}".format(total)
+            self.statusbar.set(text, clear_after=0)
+            self.statusbar.update_idletasks()
+
+        return progress
+
+    def journal_error(self):
+        self.tree_sig.journal_error()
+
     def focus_searchbar(self):
         self.searchbar.focus()
         self.searchbar.select_range(0, "end")
@@ -345,8 +403,16 @@ class RespoTool(tk.Tk):
         self.main_frame.focus_force()
 
     def quit(self):
-        logging.info("Exiting {}\n".format(__appname__))
-        logging.shutdown()
+        if self._check_archives_id:
+            self.after_cancel(self._check_archives_id)
+        try:
+            if self.journal.dirty:
+                self.journal.compact()  # Changes left in the journal otherwise, replayed on next import
+        finally:
+            self.journal.close()
+            logging.info("Exiting {}\n".format(__appname__))
+            logging.shutdown()
+            self.destroy()
         raise SystemExit
 
 
@@ -12,9 +12,35 @@ from signalement import Signalement
 logger = logging.getLogger(__name__)
 
 
+class ArchiveFile():
+    # Keeps track of what has already been parsed from an archive file so that it is only read again when it changed,
+    # and only from the last parsed byte when lines were appended to it
+    TAIL_SIZE = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.size = -1
+        self.mtime = None
+        self.tail = b""  # Last parsed bytes, compared against the file before parsing only what was appended
+        self.signalements = []
+
+    def changed(self, stat):
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime
+
+    def can_append(self, stat):
+        return stat.st_size > self.size > 0 and self.tail.endswith(b"\n")
+
+    def update(self, stat, data, signalements, append=False):
+        self.size = (self.size if append else 0) + len(data)
+        self.mtime = stat.st_mtime_ns
+        self.tail = (self.tail + data if append else data)[-ArchiveFile.TAIL_SIZE:]
+        self.signalements = self.signalements + signalements if append else signalements
+
+
 class Archives():
     read_counter = 0
     write_counter = 0
+    INDEXED_KEYS = ("code", "auteur")
 
     def __init__(self, dir_path, pattern):
         self.dir_path = dir_path
@@ -22,53 +48,131 @@ class Archives():
         self.signalements = []
         self.files = glob.glob(os.path.join(dir_path, pattern))
         self.current_file = None
+        self._archive_files = {}
+        self._indexes = {key: {} for key in Archives.INDEXED_KEYS}  # key -> value -> positions in `signalements`
 
     def refresh(self):
         self.files = glob.glob(os.path.join(self.dir_path, self.pattern))
         self.open()
 
     def open(self):
-        self.signalements = []
+        archive_files = {}
+        changed = False
         for file in self.files:
-            logger.info("Reading \"{}\"".format(file))
             self.current_file = file
+            archive_file = self._archive_files.get(file, ArchiveFile(file))
             try:
-                f = open(file, "r", encoding="utf-8")
-            except IOError as e:
+                changed |= self.read(archive_file)
+            except (IOError, ValueError, IndexError) as e:
                 logger.error(e)
             else:
-                try:
-                    raw_text = "".join(f.readlines()[2:])
-                    self.signalements.extend(self.parse(raw_text))
+                archive_files[file] = archive_file
+        if changed or archive_files.keys() != self._archive_files.keys():
+            self.signalements = [sig for archive_file in archive_files.values() for sig in archive_file.signalements]
+            self._build_indexes()
+        self._archive_files = archive_files
+
+    def read(self, archive_file):
+        stat = os.stat(archive_file.path)
+        if not archive_file.changed(stat):
+            return False
+        with open(archive_file.path, "rb") as f:
+            if archive_file.can_append(stat):
+                tail = archive_file.tail
+                f.seek(archive_file.size - len(tail))
+                data = f.read()
+                if data.startswith(tail):
+                    data = data[len(tail):]
+                    logger.info("Reading {} new bytes from \"{}\"".format(len(data), archive_file.path))
+                    archive_file.update(stat, data, self.parse(data.decode("utf-8")), append=True)
                     Archives.read_counter += 1
-                except (IOError, IndexError) as e:
-                    logger.error(e)
-                finally:
-                    f.close()
+                    return True
+                f.seek(0)
+            logger.info("Reading \"{}\"".format(archive_file.path))
+            data = f.read()
+        lines = data.decode("utf-8").split("\n", 2)
+        raw_text = lines[2] if len(lines) > 2 else ""
+        archive_file.update(stat, data, self.parse(raw_text))
+        Archives.read_counter += 1
+        return True
+
+    def _build_indexes(self):
+        for key in Archives.INDEXED_KEYS:
+            index = {}
+            for position, sig in enumerate(self.signalements):
+                index.setdefault(getattr(sig, key), []).append(position)
+            self._indexes[key] = index
+
+    def _add(self, sig):
+        for key in Archives.INDEXED_KEYS:
+            self._indexes[key].setdefault(getattr(sig, key), []).append(len(self.signalements))
+        self.signalements.append(sig)
 
     def archive_sig(self, sig):
-        if not self.files:
-            self.new_archive(os.path.join(self.dir_path, "archives_{}.txt".format(sig.datetime().year)))
-        if self.signalements and sig.datetime().month < self.signalements[-1].datetime().month:
-            self.new_archive()  # New year => new file
+        return bool(self.archive_many([sig]))
 
-        archived = False
-        logger.info("Writing {} to '{}'".format(sig.fields(), self.current_file))
+    def archive_many(self, sigs):
+        # Writes all the lines going to the same archive file at once. Returns the archived sigs, which are the first
+        # ones of `sigs` if writing to a file failed.
+        groups = []  # [(file, [sig, ...]), ...] in writing order
+        previous = self.signalements[-1] if self.signalements else None
+        for sig in sigs:
+            if not self.files:
+                self.new_archive(os.path.join(self.dir_path, "archives_{}.txt".format(sig.datetime().year)))
+            if previous and sig.datetime().month < previous.datetime().month:
+                self.new_archive()  # New year => new file
+            if not groups or groups[-1][0] != self.current_file:
+                groups.append((self.current_file, []))
+            groups[-1][1].append(sig)
+            previous = sig
+
+        archived = []
+        for path, group in groups:
+            self.current_file = path
+            text = "".join(sig.archive() + "\n" for sig in group)
+            logger.info("Writing {} sigs to '{}'".format(len(group), path))
+            if not self._write(path, text):
+                break
+            # Bytes as written by the text mode file, "\n" becoming "\r\n" on Windows
+            data = text.replace("\n", os.linesep).encode("utf-8")
+            for archived_sig in self._appended(path, data) or group:
+                self._add(archived_sig)
+            archived.extend(group)
+            Archives.write_counter += 1
+        return archived
+
+    def _write(self, path, text):
+        # Appends `text` in a single write, and truncates the file back to its previous size if anything goes wrong so
+        # that it never ends up with only part of the lines
         try:
-            f = open(self.current_file, "a", encoding="utf-8")
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.error(e)
+            return False
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
         except IOError as e:
             logger.error(e)
-        else:
             try:
-                f.write(sig.archive() + "\n")
-                self.signalements.append(sig)
-                Archives.write_counter += 1
-                archived = True
-            except IOError as e:
+                os.truncate(path, size)
+            except OSError as e:
                 logger.error(e)
-            finally:
-                f.close()
-        return archived
+            return False
+        return True
+
+    def _appended(self, path, data):
+        # Records our own writes so that the next refresh doesn't have to read them back from the file. Returns the
+        # signalements as they will be read from the archives, or None if the file has to be read again anyway.
+        archive_file = self._archive_files.get(path)
+        if archive_file:
+            stat = os.stat(path)
+            if stat.st_size == archive_file.size + len(data):
+                signalements = self.parse(data.decode("utf-8"))
+                archive_file.update(stat, data, signalements, append=True)
+                return signalements
 
     def new_archive(self, filename=None):
         if filename is None:
@@ -127,6 +231,10 @@ class Archives():
     def filter_sigs(self, key=None, values=None, exact=False, func=None, source=None):
         if key is None or values is None:
             return self.signalements
+        if exact and func is None and source is None and key in self._indexes:
+            index = self._indexes[key]
+            positions = sorted({position for value in values for position in index.get(value, [])})
+            return [self.signalements[position] for position in positions]
         s = []
         if source is None:
             source = self
@@ -136,7 +244,7 @@ class Archives():
                     if func(sig, value):
                         s.append(sig)
                         break
-                elif sig.__dict__[key] == value or (not exact and value in sig.__dict__[key]):
+                elif getattr(sig, key) == value or (not exact and value in getattr(sig, key)):
                     s.append(sig)
                     break
         return s
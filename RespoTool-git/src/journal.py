@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# !python3
+
+import json
+import logging
+import os
+import uuid
+
+import sigfile
+from signalement import Signalement
+
+logger = logging.getLogger(__name__)
+
+# Every change made to the session is appended to "<session>.journal" as one JSON line, the .sig snapshot itself only
+# being rewritten when the journal is compacted. The first line of the journal holds the identifier of the snapshot it
+# applies to, so that a journal left behind by a compaction interrupted halfway is never replayed twice.
+#
+#   {"op": "base", "session": ...}
+#   {"op": "append", "sigs": [{...}, ...]}
+#   {"op": "edit", "index": 3, "statut": "...", "respo": [...]}
+#   {"op": "delete" | "archive", "indexes": [5, 2]}     indexes are removed one after the other
+COMPACT_EVERY = 200
+ERROR_MESSAGE = "Erreur d'écriture de la session '{}', voir les logs."
+
+
+class Journal:
+    def __init__(self, snapshot, compact_every=COMPACT_EVERY):
+        self.snapshot = snapshot  # Callable returning the current list of signalements
+        self.compact_every = compact_every
+        self.path = None
+        self.session = None
+        self._file = None
+        self._records = 0
+        self._damaged = False  # The journal on disk can't be appended to and must be compacted first
+
+    @property
+    def journal_path(self):
+        return "{}.journal".format(self.path)
+
+    def open(self, path):
+        self.close()
+        self.path = path
+        self.session = None
+        self._records = 0
+        self._damaged = False
+        if os.path.exists(path):
+            self.session = sigfile.read_header(path).get("session")
+
+    def replay(self, signalements):
+        # Applies the changes recorded since the last snapshot to `signalements`, returns the number of changes
+        try:
+            f = open(self.journal_path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return 0
+        count = 0
+        with f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last record cut short by a crash
+                    logger.warning("Ignoring truncated record in '{}'".format(self.journal_path))
+                    self._damaged = True
+                    break
+                if i == 0:
+                    if record.get("op") != "base" or record.get("session") != self.session:
+                        logger.warning("Ignoring stale journal '{}'".format(self.journal_path))
+                        self._damaged = True
+                        return 0
+                    continue
+                try:
+                    apply(signalements, record)
+                except (KeyError, IndexError, TypeError) as e:
+                    logger.error("Invalid record in '{}': {}".format(self.journal_path, e))
+                    self._damaged = True
+                    break
+                count += 1
+        self._records = count
+        if count:
+            logger.info("Replayed {} changes from '{}'".format(count, self.journal_path))
+        return count
+
+    def record(self, op, **data):
+        # Returns False if the change couldn't be written, the next change then rewriting the whole session
+        if self.path is None:
+            return True
+        if self._damaged and not self.compact():
+            return False
+        try:
+            if self._file is None:
+                self._create_directory()
+                new = not os.path.exists(self.journal_path)
+                self._file = open(self.journal_path, "a", encoding="utf-8")
+                if new:
+                    self._write({"op": "base", "session": self.session})
+            self._write(dict(op=op, **data))
+        except OSError as e:
+            logger.error("Couldn't write to '{}': {}".format(self.journal_path, e))
+            self._damaged = True
+            self.close()
+            return False
+        self._records += 1
+        if self._records >= self.compact_every:
+            return self.compact()
+        return True
+
+    def _create_directory(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, signalements):
+        return self.record("append", sigs=[sig.asdict() for sig in signalements])
+
+    def edit(self, index, sig):
+        return self.record("edit", index=index, statut=sig.statut, respo=list(sig.respo))
+
+    def delete(self, indexes, op="delete"):
+        return self.record(op, indexes=list(indexes))
+
+    def compact(self, progress=None):
+        # Rewrites the snapshot with the current session and starts a new journal, returns False on failure
+        if self.path is None:
+            return True
+        self.close()
+        session = uuid.uuid4().hex
+        try:
+            self._create_directory()
+            sigfile.write(self.path, self.snapshot(), progress=progress, session=session)
+        except OSError as e:
+            logger.error("Couldn't write '{}': {}".format(self.path, e))
+            self._damaged = True
+            return False
+        self.session = session
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Left behind, it will be ignored as stale since its session isn't the one of the snapshot anymore
+            logger.error(e)
+        logger.debug("Compacted {} changes into '{}'".format(self._records, self.path))
+        self._records = 0
+        self._damaged = False
+        return True
+
+    @property
+    def dirty(self):
+        return self._records > 0 or self._damaged
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                logger.error(e)
+            self._file = None
+
+    def detach(self):
+        # Stops recording changes until the next open(), leaving the session file and its journal as they are
+        self.close()
+        self.path = None
+        self.session = None
+        self._records = 0
+        self._damaged = False
+
+
+def apply(signalements, record):
+    op = record["op"]
+    if op == "append":
+        signalements.extend(Signalement.from_dict(d) for d in record["sigs"])
+    elif op == "edit":
+        sig = signalements[record["index"]]
+        sig.statut = record["statut"]
+        sig.respo = record["respo"]
+    elif op in ("delete", "archive"):
+        for index in record["indexes"]:
+            del signalements[index]
+    else:
+        raise KeyError(op)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# !python3
+
+
+class SearchIndex:
+    # Inverted index mapping each n-gram of a column to the rows containing it. A substring query only has to check
+    # the rows sharing all of its n-grams instead of casefolding and scanning every cell of every row.
+
+    def __init__(self, n=3):
+        self.n = n
+        self.columns = []  # Casefolded cells, column by column
+        self._postings = []  # One {ngram: [row, ...]} dict per column, None until build_postings() gets to it
+        self._size = 0
+        self._last = None  # (query, rows) of the last query
+
+    def build(self, data):
+        self._size = len(data)
+        width = max((len(values) for values in data), default=0)
+        self.columns = [[str(values[i]).casefold() if i < len(values) else "" for values in data] for i in range(width)]
+        self._postings = [None] * width
+        self._last = None
+
+    def build_postings(self):
+        # Slow on large data, meant to run in a background thread. A later build() replaces both lists, so the
+        # postings of outdated columns end up in a list that's no longer used.
+        n = self.n
+        columns, postings_list = self.columns, self._postings
+        for column, texts in enumerate(columns):
+            postings = {}
+            for row, text in enumerate(texts):
+                for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+                    try:
+                        postings[gram].append(row)
+                    except KeyError:
+                        postings[gram] = [row]
+            postings_list[column] = postings
+
+    def lookup(self, column, needle):
+        # Rows whose cell in `column` contains `needle` (already casefolded)
+        texts = self.columns[column]
+        postings = self._postings[column]
+        if len(needle) < self.n or postings is None:
+            return {row for row, text in enumerate(texts) if needle in text}
+
+        grams = {needle[i:i + self.n] for i in range(len(needle) - self.n + 1)}
+        lists = []
+        for gram in grams:
+            rows = postings.get(gram)
+            if not rows:
+                return set()
+            lists.append(rows)
+        lists.sort(key=len)
+        candidates = set(lists[0])
+        for rows in lists[1:]:
+            candidates.intersection_update(rows)
+            if not candidates:
+                return candidates
+        return {row for row in candidates if needle in texts[row]}
+
+    def search(self, terms):
+        # `terms` is a list of (column, needle) pairs that must all match. A column of None matches any column.
+        result = None
+        for column, needle in sorted(terms, key=lambda term: -len(term[1])):
+            if needle == "":
+                continue
+            if column is None:
+                rows = set()
+                for i in range(len(self.columns)):
+                    rows |= self.lookup(i, needle)
+            elif column < len(self.columns):
+                rows = self.lookup(column, needle)
+            else:
+                rows = set()
+            result = rows if result is None else result & rows
+            if not result:
+                return []
+        if result is None:
+            return list(range(self._size))
+        return sorted(result)
+
+    def query(self, query):
+        # Runs a compiled searchparser.Query. When it narrows down the previous one and the previous matches are few
+        # enough, only those are checked. Broad queries are still faster to run against the postings.
+        last = self._last
+        if last is not None and len(last[1]) * 4 <= self._size and query.refines(last[0]):
+            rows = [row for row in last[1] if self.match(row, query.terms)]
+        else:
+            rows = self.search(query.terms)
+        self._last = (query, rows)
+        return rows
+
+    def match(self, row, terms):
+        columns = self.columns
+        for column, needle in terms:
+            if column is None:
+                if not any(needle in texts[row] for texts in columns):
+                    return False
+            elif column >= len(columns) or needle not in columns[column][row]:
+                return False
+        return True
+
+    def __len__(self):
+        return self._size
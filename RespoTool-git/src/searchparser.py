@@ -2,6 +2,7 @@
 # !python3
 
 import re
+from collections import OrderedDict
 
 
 class Tag:
@@ -21,16 +22,56 @@ class Tag:
         return f"<Tag index='{self.index}' label='{self.label}', label_span='{self.label_span}', content='{self.content}'>"
 
 
+class Query:
+    # A parsed query, ready to be run against casefolded rows
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = terms  # [(column index or None for any column, casefolded needle), ...]
+
+    def refines(self, other):
+        # True if every row matching this query also matches `other`, e.g. when characters or tags were added to it
+        for column, needle in other.terms:
+            if needle and not any(needle in own_needle and (column is None or column == own_column)
+                                  for own_column, own_needle in self.terms):
+                return False
+        return True
+
+    def __repr__(self):
+        return f"<Query text='{self.text}' terms={self.terms}>"
+
+
 class SearchParser:
+    CACHE_SIZE = 128
+
     def __init__(self, tags):
         self.tags = dict.fromkeys(tags)
+        # Every tag is looked for in a single pass
+        self._labels = list(self.tags)
+        self._indexes = {tag.lower(): index for index, tag in reversed(list(enumerate(self._labels)))}
+        self._regex = re.compile("(?i) ?({}):".format("|".join(re.escape(tag) for tag in self._labels)))
+        self._queries = OrderedDict()  # Compiled queries, least recently used first
+
+    def compile(self, query):
+        compiled = self._queries.get(query)
+        if compiled is not None:
+            self._queries.move_to_end(query)
+            return compiled
+
+        notag, *tags = self.parse(query)
+        terms = [(tag.index, tag.content.casefold()) for tag in tags]
+        if notag.content:
+            terms.append((None, notag.content.casefold()))
+        compiled = self._queries[query] = Query(query, terms)
+        if len(self._queries) > SearchParser.CACHE_SIZE:
+            self._queries.popitem(last=False)
+        return compiled
 
     def parse(self, query):
         tags = []
-        for index, tag in enumerate(self.tags):
-            for match in re.finditer(f"(?i) ?{tag}:", query):
-                t = Tag(index, tag, label_span=match.span())
-                tags.append(t)
+        if self.tags:
+            for match in self._regex.finditer(query):
+                index = self._indexes[match.group(1).lower()]
+                tags.append(Tag(index, self._labels[index], label_span=match.span()))
         if tags:
             tags.sort()
             for index, tag in enumerate(tags):
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# !python3
+
+import json
+import os
+
+from signalement import Signalement
+
+# Session files (.sig) are written as JSON Lines: a header line, then one signalement per line, so that they are
+# written and read one row at a time while staying readable by hand. Sessions saved as a single indented JSON array by
+# older versions can still be read.
+FORMAT = "respotool-session"
+VERSION = 2
+
+
+def header(count=None, session=None):
+    meta = {"format": FORMAT, "version": VERSION, "count": count}
+    if session:
+        meta["session"] = session
+    return json.dumps(meta)
+
+
+def read_header(path):
+    # Metadata of a session file, empty for sessions saved by older versions
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline()
+    if first.lstrip().startswith("["):
+        return {}
+    return json.loads(first)
+
+
+def encode(sig, number):
+    d = sig.ordered_dict()
+    d.update({"#": number})
+    d.move_to_end("#", last=False)
+    return json.dumps(d, ensure_ascii=False)
+
+
+def decode(line):
+    return Signalement.from_dict(json.loads(line))
+
+
+def write(path, signalements, progress=None, step=500, session=None):
+    # The file is replaced only once fully written
+    count = len(signalements)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(header(count, session) + "\n")
+        for i, sig in enumerate(signalements, 1):
+            f.write(encode(sig, i) + "\n")
+            if progress and i % step == 0:
+                progress(i, count)
+    os.replace(tmp_path, path)
+    if progress:
+        progress(count, count)
+
+
+def read(path, progress=None, step=500):
+    # Yields the signalements of the file one by one
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline()
+        if first.lstrip().startswith("["):
+            f.seek(0)
+            dicts = json.load(f)
+            for i, d in enumerate(dicts, 1):
+                yield Signalement.from_dict(d)
+                if progress and i % step == 0:
+                    progress(i, len(dicts))
+            return
+
+        meta = json.loads(first)
+        if meta.get("format") != FORMAT:
+            raise ValueError("Not a session file: '{}'".format(path))
+        count = meta.get("count")
+        i = 0
+        for line in f:
+            if line.strip():
+                i += 1
+                yield decode(line)
+                if progress and i % step == 0:
+                    progress(i, count)
@@ -1,33 +1,48 @@
 # -*- coding: utf-8 -*-
 # !python3
 
+import datetime
+import sys
 from collections import OrderedDict
-from datetime import date
 
 
 class Signalement():
     TEMPLATE = "{date:<5} {auteur:<12} {code:<14} {flag:<11} {respo:<24} {desc:<100} {statut:<60}"
+    FIELDS = ("date", "auteur", "code", "flag", "desc", "statut", "respo")
+    # No per-instance __dict__: archives can hold tens of thousands of signalements
+    __slots__ = ("_date", "_datetime", "auteur", "code", "flag", "desc", "statut", "respo")
 
     def __init__(self, date, auteur, code, flag, desc="", statut="todo", respo=None):
         self.date = date
-        self.auteur = auteur
+        self.auteur = sys.intern(str(auteur))
         self.code = code
-        self.flag = flag
+        self.flag = sys.intern(str(flag))
         self.desc = desc
         self.statut = statut
-        self.respo = [] if respo is None else respo
+        self.respo = [] if respo is None else [sys.intern(r) for r in respo]
+
+    @property
+    def date(self):
+        return self._date
+
+    @date.setter
+    def date(self, value):
+        self._date = value
+        self._datetime = None
 
     def fields(self):
         return self.date, self.auteur, self.code, self.flag, self.desc, self.statut, self.respo
 
     def datetime(self):
-        y, m, d = date.today().year, int(self.date.split("/")[1]), int(self.date.split("/")[0])
-        return date(y, m, d)
+        if self._datetime is None:
+            d, m = self.date.split("/")[:2]
+            self._datetime = datetime.date(datetime.date.today().year, int(m), int(d))
+        return self._datetime
 
     def archive(self, separator="|"):
         # Format d'archives
         template = " {} ".format(separator).join(Signalement.TEMPLATE.split(" "))
-        d = dict(self.__dict__)
+        d = self.asdict()
         d["respo"] = ", ".join(d["respo"])
         return template.format(**d)
 
@@ -35,8 +50,15 @@ class Signalement():
         # Format /sigmdm
         return "[{}] {} a signalé {} ({}) : {}".format(self.date, self.auteur, self.code[1:], self.flag, self.desc)
 
+    def asdict(self):
+        return {field: getattr(self, field) for field in Signalement.FIELDS}
+
+    def key(self):
+        # Fields compared by __eq__
+        return self.date, self.auteur, self.code, self.flag, self.desc
+
     def ordered_dict(self):
-        return OrderedDict(zip(["date", "auteur", "code", "flag", "desc", "statut", "respo"], self.fields()))
+        return OrderedDict(zip(Signalement.FIELDS, self.fields()))
 
     def playlister(self):
         # Format PlayLister de Saki + status
@@ -53,8 +75,12 @@ class Signalement():
         return str(self)
 
     def __eq__(self, other):
-        return self.date == other.date and self.auteur == other.auteur and self.code == other.code and \
-               self.flag == other.flag and self.desc == other.desc
+        if not isinstance(other, Signalement):
+            return NotImplemented
+        return self.key() == other.key()
 
     def __ne__(self, other):
         return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
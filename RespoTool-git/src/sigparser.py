@@ -9,37 +9,33 @@ from utils import log_args
 
 logger = logging.getLogger(__name__)
 
+MATCHES = {
+    "date": "([0-9]{1,2}/[0-9]{1,2})",
+    "auteur": "([a-zA-Z]{1,12})",
+    "code": "([0-9]{13})",
+    "flag": "([^\r\n]*)",
+    "desc": "([^\r\n]+)"
+}
+REGEX = re.compile(r"^\[{date}\] {auteur} a signalé {code} \({flag}\) : {desc}".format(**MATCHES), re.MULTILINE)
+
 
 @log_args(logger=logger)
 def parse(text, allow_duplicates=True, previous_sigs=None):
-    if previous_sigs is None:
-        previous_sigs = []
-    signalements = []
-
     if not isinstance(text, str):
-        return signalements
-
-    for line in text.splitlines():
-        if line == "":
+        return []
+
+    # A duplicate replaces the previous occurrence and moves to the end, sigs already present in `previous_sigs` being
+    # left out
+    signalements = {}
+    previous = set(previous_sigs) if previous_sigs and not allow_duplicates else set()
+    for match in REGEX.finditer(text):
+        date, auteur, code, flag, desc = match.groups()
+        s = Signalement(date, auteur, "@" + code, flag, desc)
+        key = s if not allow_duplicates else len(signalements)
+        if key in previous:
             continue
+        signalements.pop(key, None)
+        signalements[key] = s
 
-        matches = {
-            "date": "([0-9]{1,2}/[0-9]{1,2})",
-            "auteur": "([a-zA-Z]{1,12})",
-            "code": "([0-9]{13})",
-            "flag": "(.*)",
-            "desc": "(.+)"
-        }
-        regex = r"\[{date}\] {auteur} a signalé {code} \({flag}\) : {desc}".format(**matches)
-        match = re.match(regex, line)
-        if match:
-            date, auteur, code, flag, desc = match.groups()
-            s = Signalement(date, auteur, "@" + code, flag, desc)
-            if ((s in signalements) or (s in previous_sigs)) and (not allow_duplicates):
-                signalements.remove(s)
-            signalements.append(s)
-            logger.debug("Parsed sig : {}".format(s))
-        else:
-            logger.debug("Not a match : '{}'".format(line))
-
-    return signalements
+    logger.debug("Parsed {} sigs".format(len(signalements)))
+    return list(signalements.values())
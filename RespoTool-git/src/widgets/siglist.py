@@ -9,7 +9,7 @@ import webbrowser
 import pyperclip
 
 import utils
-from signalement import Signalement
+from journal import ERROR_MESSAGE
 from widgets.dialogs.editsigdialog import EditSigDialog
 from widgets.popup import Popup
 from widgets.treelist import Treelist
@@ -18,9 +18,10 @@ logger = logging.getLogger(__name__)
 
 
 class Siglist(Treelist):
-    def __init__(self, master, *, signalements, archives, respomap_widget, statusbar, **kwargs):
+    def __init__(self, master, *, signalements, archives, respomap_widget, statusbar, journal=None, **kwargs):
         super().__init__(master, **kwargs)
         self.signalements = signalements
+        self.journal = journal
         self.respomap_widget = respomap_widget
         self.statusbar = statusbar
         self._keys = [
@@ -34,9 +35,12 @@ class Siglist(Treelist):
             lambda x: str(x.respo)
         ]
         self.archives = archives
+        self.archives_loaded = True  # Archives aren't looked up while they are being loaded in the background
         self._last_popup_space = None
         self._last_popup_rightclick = None
         self._dialogs = []
+        self._duplicates = {}  # code -> (matching archived sigs, matching session sigs)
+        self._sigs = {}  # iid -> displayed signalement
         self.tree.bind("<Double-1>", self.on_doubleclick)
         self.tree.bind("<Button-3>", self.on_rightclick)
         self.tree.bind("<Return>", lambda _: self.edit())
@@ -62,49 +66,62 @@ class Siglist(Treelist):
     def get_templates(self):
         with open(utils.resource_path("data/duplicates_msg.json"), "r", encoding="utf-8") as f:
             self.archives_templates = json.load(f)
+        self.tree.tag_configure("duplicate", foreground=self.archives_templates["foreground"])
 
     def get_statuses(self):
         with open(utils.resource_path("data/statuses.json"), "r", encoding="utf-8") as f:
             self.statuses = json.load(f)
 
-    def insert(self, values, update=True, tags=None):
+    def row_tags(self, values, row_count):
         tags = []
         for tag in self.tags:
             keyword = tag[0]
             if keyword in values[-2]:
                 tags.append(keyword)
                 break
-        super().insert(values, update, tags)
+        if values[-5] in self._duplicates:
+            if not tags:
+                tags.append(["even_row", "odd_row"][row_count % 2])
+            tags.append("duplicate")
+        return tags
+
+    def insert(self, values, update=True, tags=None):
+        super().insert(values, update, self.row_tags(values, self._row_count + 1))
+
+    def insert_many(self, rows, update=True, tags=None):
+        tags = [self.row_tags(values, self._row_count + i) for i, values in enumerate(rows, 1)]
+        super().insert_many(rows, update, tags)
+
+    def reconcile(self, rows, tags=None):
+        tags = [self.row_tags(values, i) for i, values in enumerate(rows, 1)]
+        super().reconcile(rows, tags)
 
     def delete(self):
         if self.tree.selection():
-            for item in self.tree.selection():
-                values = self.tree.item(item)["values"]
-                values[0] = str(values[0])  # Treeviews force str to int if it's a digit
-                values[-1] = [respo.strip() for respo in values[-1].split(",")] if values[-1] else []
-                sig = Signalement(*values[1:])
-                self.signalements.remove(sig)
-                logger.debug("Deleting {}".format(sig))
+            # From the last to the first, so that each index is still valid once the previous ones are deleted
+            removed = sorted(self.selection_indexes(), reverse=True)
+            for index in removed:
+                logger.debug("Deleting {}".format(self.signalements[index]))
+                del self.signalements[index]
+            saved = self.journal.delete(removed) if self.journal else True
             index = super().delete()
             if index == len(self.tree.get_children()):
                 index -= 1
             self.refresh()
-            if self._search_query.get() != "":
-                self.search(debounced=True)
             self.focus_index(index)
+            if not saved:
+                self.journal_error()
+
+    def journal_error(self):
+        # Shown after the message of selection_handler(), triggered by the new selection
+        self.after_idle(lambda: self.statusbar.set(ERROR_MESSAGE.format(self.journal.path), clear_after=0))
 
     def selection_indexes(self):
-        indexes = []
-        for item in self.tree.selection():
-            indexes.append(int(self.tree.item(item)["values"][0]) - 1)
-        return indexes
+        # The index column holds the position of the sig in `signalements`
+        return [int(self.row(item)[0]) - 1 for item in self.tree.selection()]
 
     def get_selected_sigs(self):
-        selected = []
-        for item in self.tree.selection():
-            index = int(self.tree.item(item)["values"][0]) - 1
-            selected.append(self.signalements[index])
-        return selected
+        return [self._sigs[item] for item in self.tree.selection()]
 
     def sort(self, col, descending):
         if self.sortable:
@@ -154,32 +171,26 @@ class Siglist(Treelist):
                 self.respomap_widget.event_generate("<Button-1>")
                 return
             item = selection[0]
-            item_index = self.tree.get_children().index(item)
-            values = self.tree.item(item)["values"]
-            values[0] = str(values[0])  # Treeviews force str to int if it's a digit
-            data_index = self._data.index(values)
-            title = "Signalement #{num} ({auteur})".format(num=values[0], auteur=values[2])
-            dialog = EditSigDialog(self, statuses=self.statuses, original_text=values[-2], dialog_title=title)
+            item_index = self.tree.index(item)
+            sig = self._sigs[item]
+            sig_index = int(self.row(item)[0]) - 1
+            title = "Signalement #{num} ({auteur})".format(num=sig_index + 1, auteur=sig.auteur)
+            dialog = EditSigDialog(self, statuses=self.statuses, original_text=sig.statut, dialog_title=title)
             self._dialogs.append(dialog)
             dialog.spawn()
             new_statut = dialog.result
-            if isinstance(new_statut, str) and new_statut != values[-2]:
-                values[-1] = [respo.strip() for respo in values[-1].split(",")] if values[-1] else []
-                sig = Signalement(*values[1:])
-                sig_index = self.signalements.index(sig)
+            if isinstance(new_statut, str) and new_statut != sig.statut:
                 if respo not in sig.respo:
                     sig.respo.append(respo)
                 if " // " in new_statut and new_statut.split(" // ", 1)[1] == "/reset":
                     sig.respo = []
                 else:
                     sig.statut = new_statut
-                new_values = list(sig.fields())
-                new_values.insert(0, values[0])
-                new_values[-1] = ", ".join(new_values[-1])
-                self._data[data_index] = new_values
-                self.signalements[sig_index] = sig
-                self.refresh(keep_search_query=True)
+                saved = self.journal.edit(sig_index, sig) if self.journal else True
+                self.refresh(duplicates=False)
                 self.focus_index(item_index)
+                if not saved:
+                    self.journal_error()
             else:
                 self.focus_item(item)
 
@@ -188,7 +199,7 @@ class Siglist(Treelist):
         if len(selection) == 1:
             item = selection[0]
             cmd = "/load " if with_load else ""
-            cmd += self.tree.item(item)["values"][3]
+            cmd += self.row(item)[3]
             logger.info("Copying '{}' to the clipboard".format(cmd))
             pyperclip.copy(cmd)
             try:
@@ -211,22 +222,21 @@ class Siglist(Treelist):
         selection = self.tree.selection()
         if len(selection) == 1:
             item = selection[0]
-            code = self.tree.item(item)["values"][3]
-            match_archives = self.archives.filter_sigs("code", [code])
-            match_session = self.archives.filter_sigs("code", [code], source=self.signalements)
+            code = self.row(item)[3]
+            match_archives, match_session = self._duplicates.get(code, ([], []))
             if len(match_archives) != 0 or len(match_session) > 1:
                 self.remove_popups()
                 text = ""
                 if len(match_archives) != 0:
                     text += self.archives_templates["archives_msg"]
                     text += "\n    ".join(
-                        [""] + [self.archives_templates["archives"].format(**s.__dict__) for s in match_archives])
+                        [""] + [self.archives_templates["archives"].format(**s.asdict()) for s in match_archives])
                 if len(match_session) > 1:
                     if text:
                         text += "\n"
                     text += self.archives_templates["session_msg"]
                     text += "\n    ".join(
-                        [""] + [self.archives_templates["session"].format(**s.__dict__) for s in match_session])
+                        [""] + [self.archives_templates["session"].format(**s.asdict()) for s in match_session])
                 self.tree.see(item)
                 self.update_idletasks()
                 bbox = self.tree.bbox(item, "Code")
@@ -258,19 +268,40 @@ class Siglist(Treelist):
             dialog.cancel()
         self.dialogs = []
 
-    def populate(self):
-        for i, sig in enumerate(self.signalements):
-            f = list(sig.fields())
-            f[-1] = ", ".join(f[-1])
-            self.insert(f)
+    def find_duplicates(self):
+        # Joins the whole session against the archives by map code in a single pass
+        session = {}
+        for sig in self.signalements:
+            session.setdefault(sig.code, []).append(sig)
+        self._duplicates = {}
+        for code, match_session in session.items():
+            match_archives = self.archives.filter_sigs("code", [code], exact=True) if self.archives_loaded else []
+            if len(match_archives) != 0 or len(match_session) > 1:
+                self._duplicates[code] = (match_archives, match_session)
+
+    def update_duplicates(self):
+        # Tags the rows already displayed again, leaving the selection and any open dialog untouched
+        self.find_duplicates()
+        self.flush()
+        for item in self.tree.get_children():
+            code = self.row(item)[3]
+            tags = [tag for tag in self.tree.item(item, "tags") if tag != "duplicate"]
+            if code in self._duplicates:
+                tags.append("duplicate")
+            self.tree.item(item, tags=tags)
+            self._shown[item] = (self._shown[item][0], tuple(tags))
 
-    def refresh(self, keep_search_query=False):
+    def refresh(self, duplicates=True):
+        # Each sig keeps the same iid from one refresh to the next, so that only the rows that changed are updated in
+        # the Treeview, see Treelist.reconcile()
         self.close_dialogs()
-        if keep_search_query:
-            key = self._search_query.get()
-            if key != "" and key not in self.search_excludes:
-                self.search(debounced=True)
-                return
-        self.clear()
-        self.populate()
-        self._matches_label.set("")
+        if duplicates:
+            self.find_duplicates()
+        rows = []
+        self._sigs = {}
+        for sig in self.signalements:
+            f = list(sig.fields())
+            f[-1] = ", ".join(f[-1])
+            rows.append(f)
+            self._sigs["S{}".format(id(sig))] = sig
+        self.replace(rows, list(self._sigs))
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 # !python3
 
+import bisect
+import collections
 import logging
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
 
+import searchindex
 import searchparser
 
 logger = logging.getLogger(__name__)
@@ -31,7 +35,7 @@ class _TreeScroll(ttk.Treeview):
 class Treelist(ttk.Frame):
     def __init__(self, master, headers, column_widths=None, height=15, alt_colors=None, sortable=True, sort_keys=None,
                  stretch_bools=None, index_options=None, debounce_time=300, search_excludes=None, match_template=None,
-                 search_tags=None, scroll_speed=3, **kwargs):
+                 search_tags=None, scroll_speed=3, chunk_size=500, **kwargs):
         ttk.Frame.__init__(self, master, **kwargs)
         self.master = master
         self.headers = headers
@@ -76,10 +80,14 @@ class Treelist(ttk.Frame):
 
         # A list of tags used to search, e.g. "respo:jinai" where "respo" is the tag
         self.search_tags = search_tags if search_tags else headers
+        self._parser = searchparser.SearchParser(self.search_tags)  # Keeps the compiled queries
 
         # Number of lines to scroll when using the mouse wheel. Internally, a scroll speed of N is represented as N-1
         self.scroll_speed = max(scroll_speed - 1, 0)
 
+        # Number of rows created per idle callback by insert_many()
+        self.chunk_size = chunk_size
+
         # Internal variables
         self._search_query = tk.StringVar()
         self._search_query.trace("w", lambda *x: self.search())
@@ -87,7 +95,18 @@ class Treelist(ttk.Frame):
         self._matches_label = tk.StringVar()  # Contains the number of matches (formatted) yielded by the search query
         self._debounce_after_id = None
         self._data = []  # Contains inserted values
+        self._index = searchindex.SearchIndex()  # Inverted index over `_data`, rebuilt lazily when `_data` changes
+        self._index_dirty = True
+        self._index_rows = []  # Rows of `_data` in the order they had when the index was built
+        self._positions = None  # {id(row): position in `_data`} once `_data` is sorted, None while in index order
+        self._sorted = {}  # Column index -> rows of `_data` sorted by that column, see sort()
         self._row_count = 0  # Used for colored odd rows
+        self._pending = collections.deque()  # Rows prepared by insert_many() but not yet inserted into the Treeview
+        self._pending_after_id = None
+        self._shown = {}  # Values and tags of every Treeview item, to compare them without querying the Treeview
+        self._rows = {}  # iid -> row of `_data`, each row being displayed by the Treeview item of the same iid
+        self._iids = {}  # id(row) -> iid
+        self._last_iid = 0
 
         self._setup_widgets()
 
@@ -122,45 +141,119 @@ class Treelist(ttk.Frame):
             self.tree.heading(header, text=header, anchor="w", command=lambda h=header: self.sort(h, True))
             self.tree.column(self.headers[i], width=self.column_widths[i], stretch=self.stretch_bools[i])
 
-    def insert(self, values, update=True, tags=None):
+    def insert(self, values, update=True, tags=None, iid=None):
+        # `iid` identifies the row for as long as it stays in `_data`, a new one being generated when not given
         self._row_count += 1
+        row = values
         values = list(values)
         tags = tags if tags else []
         if update:
             values.insert(0, str(self._row_count))
             self._data.append(values)
+            self._add_row(values, iid)
+            self._data_changed()
+            row = values
         if not tags:
             tags.append(["even_row", "odd_row"][self._row_count % 2])
-        self.tree.insert("", "end", values=values, tags=tags)
+        if self._pending:
+            self._pending.append((self._iids[id(row)], values, tags))  # Keeps the rows in order
+            return
+        self._insert_item("end", self._iids[id(row)], values, tags)
+
+    def _add_row(self, values, iid=None):
+        if iid is None:
+            self._last_iid += 1
+            iid = "R{}".format(self._last_iid)
+        self._rows[iid] = values
+        self._iids[id(values)] = iid
+
+    def _insert_item(self, index, iid, values, tags):
+        values, tags = tuple(values), tuple(tags)
+        self.tree.insert("", index, iid=iid, values=values, tags=tags)
+        self._shown[iid] = (values, tags)
+
+    def insert_many(self, rows, update=True, tags=None, iids=None):
+        # Same as calling insert() for each row, the Treeview items being created `chunk_size` at a time from idle
+        # callbacks so that the window stays responsive while thousands of rows are inserted
+        tags = tags if tags else [None] * len(rows)
+        iids = iids if iids else [None] * len(rows)
+        for values, row_tags, iid in zip(rows, tags, iids):
+            self._row_count += 1
+            if update:
+                values = list(values)
+                values.insert(0, str(self._row_count))
+                self._data.append(values)
+                self._add_row(values, iid)
+            if not row_tags:
+                row_tags = [["even_row", "odd_row"][self._row_count % 2]]
+            self._pending.append((self._iids[id(values)], values, row_tags))
+        if update:
+            self._data_changed()
+        if self._pending and self._pending_after_id is None:
+            self._pending_after_id = self.after_idle(self._insert_pending, self.chunk_size)
+
+    def _insert_pending(self, count=None):
+        self._pending_after_id = None
+        count = len(self._pending) if count is None else min(count, len(self._pending))
+        for _ in range(count):
+            self._insert_item("end", *self._pending.popleft())
+        if self._pending:
+            self._pending_after_id = self.after_idle(self._insert_pending, self.chunk_size)
+
+    def flush(self):
+        # Inserts the pending rows right away, for the code that needs every item of the Treeview
+        if self._pending_after_id is not None:
+            self.after_cancel(self._pending_after_id)
+        self._insert_pending()
+
+    def row(self, item):
+        # Values of the row displayed by `item`, index included
+        return self._rows[item]
 
     def delete(self):
+        self.flush()
         selection = self.tree.selection()
-        index = 0
+        if not selection:
+            return 0
+        # Position of the last selected item once the items before it are deleted
+        index = self.tree.index(selection[-1]) - len(selection) + 1
+        deleted = set()
         for item in selection:
-            if item == selection[-1]:
-                index = self.tree.get_children().index(item)
-            values = self.tree.item(item)["values"]
-            values[0] = str(values[0])
-            self._data.remove(values)
-            self.tree.delete(item)
-            self._row_count -= 1
+            deleted.add(id(self._rows.pop(item)))
+            del self._shown[item]
+        self._data[:] = [values for values in self._data if id(values) not in deleted]
+        for key in deleted:
+            del self._iids[key]
+        self.tree.delete(*selection)
+        self._row_count -= len(selection)
+        self._data_changed()
         return index
 
     def clear(self, keep_data=False):
         self._row_count = 0
+        if self._pending_after_id is not None:
+            self.after_cancel(self._pending_after_id)
+            self._pending_after_id = None
+        self._pending.clear()
         self.tree.delete(*self.tree.get_children())
+        self._shown.clear()
         if not keep_data:
             del self._data[:]
+            self._rows.clear()
+            self._iids.clear()
+            self._data_changed()
 
     def scroll_up(self):
         self.update()
         self.tree.yview_moveto(0)
 
     def scroll_down(self):
+        self.flush()
         self.update()
         self.tree.yview_moveto(1)
 
     def focus_index(self, index, visible=False):
+        self.flush()
         rows = self.tree.get_children()
         row_count = len(rows)
         if -row_count <= index < row_count:
@@ -181,19 +274,26 @@ class Treelist(ttk.Frame):
 
     def sort(self, col, descending):
         if self.sortable:
-            tree_data = [(self.tree.set(child, col), self.tree.set(child, 0), child) for child in
-                         self.tree.get_children("")]
             index = self.headers.index(col)
-            tree_data.sort(reverse=descending, key=lambda x: (self.sort_keys[index](x), int(x[1])))
-            self._data.sort(reverse=descending, key=lambda x: (self.sort_keys[index]([x[index]]), int(x[0])))
-            for index, item in enumerate(tree_data):
-                self.tree.move(item[2], "", index)
-                self.tree.item(item[2], tags=[["even_row", "odd_row"][(index + 1) % 2]])
+            self._data[:] = self._sorted_rows(index, descending)
+            # The rows themselves didn't change: the index is kept, its matches being put back in the new order
+            self._positions = {}
             # Switch heading command to reverse the sort next time
             self.tree.heading(col, command=lambda col=col: self.sort(col, not descending))
-            # In case the user is in the middle of a search
+            # Makes search() display `_data` in its new order, or the matches of the current search in that order
+            self._last_search_query = None
             self.search(debounced=True)
 
+    def _sorted_rows(self, index, descending):
+        # The ascending order of each column is kept until `_data` changes, the descending order being its reverse since
+        # the index column breaks ties
+        rows = self._sorted.get(index)
+        if rows is None:
+            key = self.sort_keys[index]
+            rows = sorted(self._data, key=lambda x: (key([x[index], x]), int(x[0])))
+            self._sorted[index] = rows
+        return rows[::-1] if descending else list(rows)
+
     def search(self, query=None, debounced=False):
         if self.debounce_time > 0 and not debounced:
             id = self._debounce_after_id
@@ -211,34 +311,99 @@ class Treelist(ttk.Frame):
             return
 
         logger.debug("Searching for '{}'".format(query))
-        self.clear(keep_data=True)
         if query == "":
-            for values in self._data:
-                self.insert(values, update=False)
+            self.reconcile(self._data)
             self._matches_label.set("")
         else:
-            matches = 0
-            notag, *tags = searchparser.SearchParser(self.search_tags).parse(query)
-            for values in self._data:
-                for tag in tags:
-                    if not tag.content.lower() in str(values[tag.index]).lower():
-                        break
-                else:
-                    if notag.content:
-                        for item in values:
-                            if notag.content.lower() in str(item).lower():
-                                self.insert(values, update=False)
-                                matches += 1
-                                break
-                    else:
-                        self.insert(values, update=False)
-                        matches += 1
-            self._matches_label.set(self.match_template.format(matches, len(self._data)))
+            rows = self.build_index().query(self._parser.compile(query))
+            self.reconcile(self._matching_rows(rows))
+            self._matches_label.set(self.match_template.format(len(rows), len(self._data)))
 
         self._last_search_query = query
         self.scroll_up()
 
+    def replace(self, rows, iids=None):
+        # Same as clear() followed by insert_many(rows, iids=iids) and search(), through reconcile(). The items of the
+        # rows keeping their iid are reused
+        self._data[:] = [[str(i)] + list(values) for i, values in enumerate(rows, 1)]
+        self._rows.clear()
+        self._iids.clear()
+        for values, iid in zip(self._data, iids if iids else [None] * len(self._data)):
+            self._add_row(values, iid)
+        self._data_changed()
+        self._last_search_query = None  # Makes search() display the new rows even when there is no search query
+        self.search(debounced=True)
+
+    def reconcile(self, rows, tags=None):
+        # Displays `rows` (rows of `_data`) in place of the current items. The items of the rows already displayed are
+        # kept, so that only the rows that changed cost Treeview calls
+        if self._pending_after_id is not None:
+            self.after_cancel(self._pending_after_id)
+            self._pending_after_id = None
+        self._pending.clear()
+        children = self.tree.get_children()
+        if not children:
+            self.clear(keep_data=True)
+            self.insert_many(rows, update=False, tags=tags)
+            return
+
+        tags = tags if tags else [None] * len(rows)
+        positions = {item: position for position, item in enumerate(children)}
+        targets = []
+        for row, (values, row_tags) in enumerate(zip(rows, tags), 1):
+            iid = self._iids[id(values)]
+            values = tuple(values)
+            row_tags = tuple(row_tags) if row_tags else (["even_row", "odd_row"][row % 2],)
+            targets.append((positions.pop(iid, None), iid, values, row_tags))
+        stale = list(positions)
+        if stale:
+            self.tree.delete(*stale)
+            for item in stale:
+                del self._shown[item]
+
+        # The items already in the right order relative to each other stay in place, the others are moved (or
+        # inserted) right after the item of the previous row
+        in_place = _increasing([position for position, _, _, _ in targets if position is not None])
+        previous = None
+        for position, item, values, row_tags in targets:
+            if position is None:
+                self._insert_item(self.tree.index(previous) + 1 if previous else 0, item, values, row_tags)
+            else:
+                if position not in in_place:
+                    self.tree.detach(item)
+                    self.tree.move(item, "", self.tree.index(previous) + 1 if previous else 0)
+                if self._shown[item] != (values, row_tags):
+                    self.tree.item(item, values=values, tags=row_tags)
+                    self._shown[item] = (values, row_tags)
+            previous = item
+        self._row_count = len(rows)
+
+    def _matching_rows(self, rows):
+        # Rows of `_data` at the positions `rows` of the index, in the current order of `_data`
+        matches = [self._index_rows[row] for row in rows]
+        if self._positions is not None:
+            if not self._positions:
+                self._positions.update((id(row), i) for i, row in enumerate(self._data))
+            matches.sort(key=lambda row: self._positions[id(row)])
+        return matches
+
+    def _data_changed(self):
+        # Rows were added, removed or edited: the search index and the sorted orders are outdated
+        self._index_dirty = True
+        self._sorted.clear()
+
+    def build_index(self):
+        # The postings are built by a background thread, queries scanning the casefolded columns until they are ready
+        if self._index_dirty:
+            self._index.build(self._data)
+            self._index_dirty = False
+            self._index_rows = list(self._data)
+            self._positions = None
+            threading.Thread(target=self._index.build_postings, daemon=True).start()
+        return self._index
+
     def select_all(self):
+        self.flush()
         self.tree.selection_set(self.tree.get_children())
 
     def deselect_all(self):
@@ -249,3 +414,25 @@ class Treelist(ttk.Frame):
         if event.delta > 0:
             direction = -1
         self.tree.yview_scroll(self.scroll_speed * direction, "units")
+
+
+def _increasing(sequence):
+    # Values of a longest strictly increasing subsequence of `sequence`
+    tails = []  # tails[k] is the smallest last value of the increasing subsequences of length k + 1 found so far
+    tail_indexes = []
+    parents = []
+    for i, value in enumerate(sequence):
+        k = bisect.bisect_left(tails, value)
+        parents.append(tail_indexes[k - 1] if k else None)
+        if k == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+        else:
+            tails[k] = value
+            tail_indexes[k] = i
+    values = set()
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        values.add(sequence[i])
+        i = parents[i]
+    return values